@@ -9,6 +9,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from MainWindow import Ui_MainWindow
 from parse_particles import parse_particles
+from catalog import folder_bytes
 
 class EntryDataModel(QAbstractListModel):
     def __init__(self, *args, entries=None, **kwargs):
@@ -114,21 +115,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
                 self.update_entry_model()
 
     def get_directory_size(self, dir_path):
-        total = 0
-        try:
-            for entry in os.scandir(dir_path):
-                if entry.is_file():
-                    total += entry.stat().st_size
-                elif entry.is_dir():
-                    total += self.get_directory_size(entry.path)
-        
-        except NotADirectoryError:
-            return os.path.getsize(directory)
-
-        except PermissionError:
-            return 0
-
-        return total
+        # sizes are measured without following the symbolic links to the micrographs
+        return folder_bytes(dir_path)
 
     def get_size_format(self, num_bytes, factor=1024, suffix='B'):
         for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
@@ -10,6 +10,7 @@ from PyQt5.QtWidgets import *
 from mainwindow import Ui_MainWindow
 from file_crawler import parse_relion_project, parse_csparc_project
 from file_crawler import parse_particles_cryoem_projects
+from catalog import Catalog
 
 class entryItem(QStandardItem):
         def __init(self, txt='', font_size=16, set_bold=True, color=QColor(255, 255, 255), data={}):
@@ -98,35 +99,25 @@ class MainWindow(QMainWindow, Ui_MainWindow):
 
     def update_dbModel(self):
         self.dbModel.entries = []
-        entries = [os.path.join('../Database', f) for f in os.listdir('../Database') if
-                os.path.isdir(os.path.join('../Database/', f))]
-
-        for entry in entries:
-                entryList = []
-                entryName = os.path.basename(os.path.normpath(entry))
-                entryList.append('%s %s' % (entryName, self.get_size_format(self.get_directory_size(entry))))
-                
-                particles_path = os.path.join(entry, 'Particles')
-                subEntries = [os.path.join(particles_path, f) for f in os.listdir(particles_path) if os.path.isdir(os.path.join(particles_path, f))]
-                for i in range(0, len(subEntries)):
-                        entryList.append({})
-                        with open(os.path.join(subEntries[i], 'info.txt'), 'r') as info_f:
-                                num_particles = info_f.readline().split()[-1]
-                                num_mics = info_f.readline().split()[-1]
-                                voltage = info_f.readline().split()[-1]
-                                cs = info_f.readline().split()[-1]
-                                amp_cont = info_f.readline().split()[-1]
-                                psize = info_f.readline().split()[-1]
-
-                                entryList[i+1]['job_type'] = os.path.split(subEntries[i])[-1]
-                                entryList[i+1]['num_particles'] = num_particles
-                                entryList[i+1]['num_mics'] = num_mics
-                                entryList[i+1]['voltage'] = voltage
-                                entryList[i+1]['cs'] = cs
-                                entryList[i+1]['amp_cont'] = amp_cont
-                                entryList[i+1]['psize'] = psize
-                                entryList[i+1]['job_size'] = self.get_size_format(self.get_directory_size(subEntries[i]))
-                self.dbModel.entries.append(entryList)
+        # entries, their jobs and sizes are looked up in the catalog of the database instead of
+        # reading every info.txt and walking every folder
+        with Catalog('../Database') as catalog:
+                for entry in catalog.entries():
+                        entryList = []
+                        entryList.append('%s %s' % (entry['name'], self.get_size_format(entry['bytes'])))
+
+                        for job in catalog.jobs(entry['name']):
+                                entryList.append({})
+                                entryList[-1]['job_type'] = job['folder']
+                                entryList[-1]['num_particles'] = '%d' % job['num_particles']
+                                entryList[-1]['num_mics'] = '%d' % job['num_mics']
+                                entryList[-1]['num_missing'] = '%d' % (job['num_missing'] or 0)
+                                entryList[-1]['voltage'] = '%d' % job['voltage']
+                                entryList[-1]['cs'] = '%g' % job['cs']
+                                entryList[-1]['amp_cont'] = '%g' % job['amp_contrast']
+                                entryList[-1]['psize'] = '%g' % job['pixel_size']
+                                entryList[-1]['job_size'] = self.get_size_format(job['bytes'])
+                        self.dbModel.entries.append(entryList)
 
         rootItem = self.dbModel.invisibleRootItem()
         # Entries are stored as a list of lists, where each sublist
@@ -161,23 +152,6 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.nParticlesValue.setText(selected_sub_entry.data['num_particles'])
             self.nMicsValue.setText(selected_sub_entry.data['num_mics'])
     
-    def get_directory_size(self, dir_path):
-        total = 0
-        try:
-            for entry in os.scandir(dir_path):
-                if entry.is_file():
-                    total += entry.stat().st_size
-                elif entry.is_dir():
-                    total += self.get_directory_size(entry.path)
-        
-        except NotADirectoryError:
-            return os.path.getsize(directory)
-
-        except PermissionError:
-            return 0
-
-        return total
-
     def get_size_format(self, num_bytes, factor=1024, suffix='B'):
         for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
             if num_bytes < factor:
@@ -39,6 +39,9 @@
 import os
 import os.path
 import re
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 ######
 # This module implements access to STAR files (includes files used by Relion 
@@ -49,8 +52,13 @@ import re
 # 
 # The STAR file is represented as a dictionary-like abstraction of the physical file on disk. 
 # Changes to the abstract object will be syncronized with the file when only explicitly requested.
-# The entire file is kept in RAM, and the file is only re-read from disk if 'readfile()' is
-# explicitly called (which will overwrite any changes in memory). 
+# The file is only re-read from disk if 'readfile()' is explicitly called (which will overwrite any
+# changes in memory). 
+#
+# The dictionary holds a single data block at a time (by default the first one). On first read, the
+# file is scanned once to build an index of the byte offsets of every data block and loop (self.index),
+# so a named block (eg - 'particles' in Relion 3.1 files, after 'optics') can be read directly with
+# readfile(name) or readblock(name) without parsing the blocks before it.
 #
 # There is no support for schema, or constrained datatypes for values. Values may be int, float or string.
 #
@@ -62,43 +70,341 @@ import re
 # loop values are represented as a python list. keys from the same loop should have an identical number
 # of elements. loops are identified internally as a list of lists (self.loop) independent of the
 # actual data storage.
+#
+# For very large loops (eg - Relion Refine3D run_itXXX_data.star files), iterloop() streams the rows
+# of a single loop directly from disk without reading the file into RAM or filling the dictionary.
+#
+# With columnar=True, loop values are instead stored as typed NumPy arrays, one per key. The type of
+# each column is inferred once from a sample of rows, and whole columns are converted at a time. String
+# columns (eg - rlnMicrographName) are dictionary-encoded as an EncodedColumn of integer codes.
+#
+# If a list of columns is given, only those loop keys are converted and stored. The other values of
+# each row are skipped over, which saves most of the parsing time on wide tables.
+#
+# In columnar mode with nproc > 1, the data of loops larger than parallel_threshold bytes is split into
+# byte ranges on line boundaries, which are converted in a pool of processes and joined at the end.
+# This assumes one loop row per line, as written by Relion.
+#
+# writefile() and writestar() write loops a column at a time: each column is formatted to strings in a
+# single NumPy operation, and the formatted rows are written in large batches.
 ######
 
+# number of loop rows converted to arrays at a time in columnar mode, and sampled to infer column types
+COLUMNAR_BATCH_ROWS = 100000
+COLUMNAR_SAMPLE_ROWS = 1000
+
+# size in bytes of the data of a loop above which it is parsed in parallel, when nproc > 1
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+def _isdata(line):
+    """True for a stripped line (bytes or str) that is loop data rather than a key, loop_ or data_ line"""
+    return line[:1] not in ('_', b'_') and line[:5].lower() not in ('loop_', 'data_', b'loop_', b'data_')
+
+def _iterlines(filename, start, end, nlines):
+    """Reads the byte range [start, end) of a file and yields lists of up to nlines stripped lines,
+    leaving out empty lines and comments"""
+    fp = open(filename, 'rb')
+    try:
+        fp.seek(start)
+        remaining = end - start
+        rest = b''
+        lines = []
+        while remaining > 0:
+            buf = fp.read(min(remaining, 1 << 24))
+            if len(buf) == 0: break
+            remaining -= len(buf)
+            buf = rest + buf
+            if remaining > 0: # keep any partial last line for the next read
+                cut = buf.rfind(b'\n') + 1
+                buf, rest = buf[:cut], buf[cut:]
+            for line in buf.decode().splitlines():
+                line = line.strip()
+                if len(line) == 0 or line[0] == '#': continue
+                lines.append(line)
+                if len(lines) == nlines:
+                    yield lines
+                    lines = []
+        if lines: yield lines
+    finally:
+        fp.close()
+
 def goodval(vals):
-    val = max(vals)
+    return _convert(max(vals))
+
+def _convert(val):
+    """Converts a single token to an int or a float if possible, otherwise returns the string"""
     try: val = int(val)
     except:
         try: val = float(val)
         except: pass
     return val
 
+class EncodedColumn(object):
+    """A dictionary-encoded column of strings. 'categories' is a sorted array of the distinct values
+    and 'codes' holds the index into 'categories' of the value in each row. Indexing with an integer
+    returns the string, iterating yields the strings, and decode() returns a full array of strings."""
+
+    def __init__(self, categories, codes):
+        self.categories = categories
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, np.integer)):
+            return self.categories[self.codes[i]]
+        return EncodedColumn(self.categories, self.codes[i])
+
+    def __iter__(self):
+        categories = self.categories
+        for code in self.codes:
+            yield categories[code]
+
+    def decode(self):
+        return self.categories[self.codes]
+
+def _tokenize(lines, matcher):
+    """Splits loop data lines into a flat list of tokens"""
+    for line in lines:
+        if line[0] == ';': raise Exception("StarFile: multi-line string values in loops are not supported in columnar mode")
+    text = " ".join(lines)
+    if '"' in text or "'" in text:
+        return [max(i) for i in matcher.findall(text)]
+    return text.split()
+
+def _inferdtype(tokens):
+    """Returns the dtype for a column from a sample of its tokens: int64, float64 or str"""
+    sample = np.array(tokens)
+    for dtype in (np.int64, np.float64):
+        try:
+            sample.astype(dtype)
+            return dtype
+        except ValueError: pass
+    return str
+
+def _convertcolumn(tokens, dtype):
+    """Converts a list of tokens for one column to an array of the given dtype. Numeric columns which fail
+    to convert are promoted, int64 -> float64 -> str. String columns are returned as (categories, codes)."""
+    col = np.array(tokens)
+    if dtype is not str:
+        try: return col.astype(dtype)
+        except ValueError: pass
+        if dtype is np.int64:
+            try: return col.astype(np.float64)
+            except ValueError: pass
+    categories, codes = np.unique(col, return_inverse = True)
+    return (categories, codes.astype(np.int32))
+
+def _concatcolumn(chunks):
+    """Joins the converted chunks of a column into a single array or EncodedColumn"""
+    if not any(isinstance(chunk, tuple) for chunk in chunks):
+        if len(chunks) == 1: return chunks[0]
+        return np.concatenate(chunks)
+
+    # A string column, or a numeric column that was promoted to strings part way through
+    chunks = [chunk if isinstance(chunk, tuple) else np.unique(chunk.astype(str), return_inverse = True) for chunk in chunks]
+    categories = np.unique(np.concatenate([chunk[0] for chunk in chunks]))
+    codes = [np.searchsorted(categories, chunk[0]).astype(np.int32)[chunk[1]] for chunk in chunks]
+    return EncodedColumn(categories, np.concatenate(codes) if codes else np.zeros(0, np.int32))
+
+def _convertlines(keys, batches, matcher, keep, dtypes):
+    """Converts batches of data lines of a loop into a dictionary of column number -> list of converted
+    chunks, for the column numbers in keep. Column types missing from dtypes are inferred from the first batch."""
+    ncols = len(keys)
+    chunks = dict((i, []) for i in keep)
+    for lines in batches:
+        tokens = _tokenize(lines, matcher)
+        if len(tokens) % ncols != 0:
+            raise Exception("StarFile: Mismatch between the number of values and the %d keys of loop %s" % (ncols, keys))
+        for i in keep:
+            if i not in dtypes:
+                dtypes[i] = _inferdtype(tokens[i:COLUMNAR_SAMPLE_ROWS * ncols:ncols])
+            chunks[i].append(_convertcolumn(tokens[i::ncols], dtypes[i]))
+    return chunks
+
+def _joincolumns(keys, keep, chunks):
+    """Joins the lists of converted chunks into a dictionary of key -> typed column"""
+    result = {}
+    for i in keep:
+        if not chunks[i]: chunks[i].append(np.zeros(0)) # loop without any rows
+        result[keys[i]] = _concatcolumn(chunks[i])
+    return result
+
+def _readcolumns(keys, batches, matcher, columns = None):
+    """Converts batches of data lines of a loop into a dictionary of key -> typed column.
+    If columns is given, only the keys in it are converted and returned."""
+    keep = [i for i in range(len(keys)) if columns is None or keys[i] in columns]
+    return _joincolumns(keys, keep, _convertlines(keys, batches, matcher, keep, {}))
+
+def _splitrange(filename, start, end, n):
+    """Splits the byte range [start, end) of a file into up to n ranges, each ending on a line boundary"""
+    bounds = [start]
+    fp = open(filename, 'rb')
+    for k in range(1, n):
+        pos = start + (end - start) * k // n
+        if pos <= bounds[-1]: continue
+        fp.seek(pos - 1)
+        fp.readline() # move to the start of the next line
+        pos = fp.tell()
+        if pos >= end: break
+        if pos > bounds[-1]: bounds.append(pos)
+    fp.close()
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _readcolumnrange(filename, start, end, keys, keep, dtypes):
+    """Worker for _readcolumnsparallel. Converts the loop data lines in a byte range of the file."""
+    matcher = re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
+    return _convertlines(keys, _iterlines(filename, start, end, COLUMNAR_BATCH_ROWS), matcher, keep, dict(dtypes))
+
+def _readcolumnsparallel(filename, start, end, keys, matcher, columns, nproc):
+    """Same as _readcolumns for the loop data in the byte range [start, end) of a file, but the range is split
+    on line boundaries and converted in a pool of nproc processes. Column types are inferred once from a
+    sample at the start of the loop, so that all of the processes produce chunks of the same types."""
+    ncols = len(keys)
+    keep = [i for i in range(ncols) if columns is None or keys[i] in columns]
+    sample = _tokenize(next(_iterlines(filename, start, end, COLUMNAR_SAMPLE_ROWS), []), matcher)
+    dtypes = dict((i, _inferdtype(sample[i::ncols])) for i in keep)
+
+    # a few ranges per process keeps the processes busy when some ranges are slower than others
+    ranges = _splitrange(filename, start, end, nproc * 4)
+    # the processes are started by a forkserver, as forking a process running threads or holding an SQLite
+    # connection (eg - a crawler, see file_crawler.py) can deadlock them
+    with ProcessPoolExecutor(max_workers = nproc, mp_context = multiprocessing.get_context('forkserver')) as pool:
+        futures = [pool.submit(_readcolumnrange, filename, range_start, range_end, keys, keep, dtypes) for range_start, range_end in ranges]
+        results = [future.result() for future in futures]
+
+    chunks = dict((i, [chunk for result in results for chunk in result[i]]) for i in keep)
+    return _joincolumns(keys, keep, chunks)
+
 class StarFile(dict):
 
-    def __init__(self, filename):
+    def __init__(self, filename, streaming = False, columnar = False, columns = None, block = None,
+                 nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+        """If streaming is set, the file is not read into the dictionary on creation. Use iterloop()
+        to read the rows of a loop, or readfile() to load a block later. If columnar is set, loop
+        values are stored as NumPy arrays and EncodedColumns instead of lists. If columns is a list of
+        keys, only those loop keys are read; other loop values are skipped without being converted.
+        block is the name of the data block to read (without 'data_'); the first block by default.
+        In columnar mode, loops with more than parallel_threshold bytes of data are parsed with nproc processes."""
         dict.__init__(self)
         self.filename = filename
         self.loops = []
+        self.columnar = columnar
+        self.columns = None if columns is None else set(columns)
+        self.block = block
+        self.index = None
+        self.nproc = nproc
+        self.parallel_threshold = parallel_threshold
 
-        if os.path.isfile(filename):
+        if os.path.isfile(filename) and not streaming:
             self.readfile()
 
+    def getindex(self):
+        """Returns the index of the data blocks in the file, building it on first use. The index is a
+        dictionary of block name -> {'start', 'end', 'loops'}, in file order, where 'start' and 'end' are
+        byte offsets and 'loops' is a list of {'keys', 'header', 'start', 'end'} for each loop in the
+        block, with 'start' and 'end' giving the byte range of the loop's data lines."""
+        if self.index is None: self._buildindex()
+        return self.index
+
+    def _buildindex(self):
+        """Scans the whole file once, recording the byte offsets of every data block and loop"""
+        index = {}
+        block = None
+        loop = None     # loop whose header or data lines are being scanned
+        pos = 0
+
+        fp = open(self.filename, 'rb')
+        for line in fp:
+            start = pos
+            pos += len(line)
+            line = line.strip()
+            if len(line) == 0 or line[:1] == b'#': continue
+
+            if loop is not None:
+                if loop['start'] is None:
+                    if line[:1] == b'_':
+                        loop['keys'].append(line.split()[0][1:].decode())
+                        continue
+                    loop['start'] = start
+                if _isdata(line): continue
+                loop['end'] = start
+                loop = None
+
+            if line[:5].lower() == b'data_':
+                if block is not None: block['end'] = start
+                block = {'start': start, 'end': None, 'loops': []}
+                index[line[5:].decode()] = block
+                continue
+
+            if block is None: # content before any data_ line, treated as an unnamed block
+                block = {'start': 0, 'end': None, 'loops': []}
+                index[''] = block
+            if line[:5].lower() == b'loop_':
+                loop = {'keys': [], 'header': start, 'start': None, 'end': None}
+                block['loops'].append(loop)
+        fp.close()
+
+        if loop is not None:
+            if loop['start'] is None: loop['start'] = pos
+            loop['end'] = pos
+        if block is not None: block['end'] = pos
+        self.index = index
+
+    def readblock(self, name):
+        """Returns a new StarFile holding the named data block, read with the same settings as this one.
+        The index of this file is reused, so the file is not scanned again."""
+        star_file = StarFile(self.filename, streaming = True, columnar = self.columnar, columns = self.columns, block = name,
+                             nproc = self.nproc, parallel_threshold = self.parallel_threshold)
+        star_file.index = self.getindex()
+        star_file.readfile()
+        return star_file
+
     def _nextline(self):
         """Used internally when parsing a star file to emulate readline"""
         self.lineptr += 1
         return self.lines[self.lineptr - 1]
 
-    def readfile(self):
-        """This parses the STAR file, replacing any previous contents in the dictionary"""
+    def readfile(self, block = None):
+        """This parses one data block of the STAR file, replacing any previous contents in the dictionary.
+        block is the name of the block (without 'data_'); if not given, self.block or the first block is read."""
         self.loops = []
         self.clear()
 
         matcher = re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
 
-        # read the entire file into a buffer, this dramatically simplifies, even if it eats a chunk of RAM
-        fp = open(self.filename, 'r')
-        self.lines = [i for i in fp.readlines() if len(i.strip()) != 0 and i[0] != '#']
+        index = self.getindex()
+        if block is None: block = self.block
+        if block is None:
+            if not index: return
+            block = next(iter(index))
+        if block not in index:
+            raise Exception("StarFile: %s has no data block named 'data_%s'" % (self.filename, block))
+        self.block = block
+        self.dataname = block
+        info = index[block]
+
+        # Seek to the block and read it into a buffer. In columnar mode the data lines of loops are left
+        # out, and are read later straight from their byte range in the file, a batch of lines at a time.
+        regions = [(info['start'], info['end'])]
+        if self.columnar:
+            regions = []
+            start = info['start']
+            for loop in info['loops']:
+                regions.append((start, loop['start']))
+                start = loop['end']
+            regions.append((start, info['end']))
+
+        fp = open(self.filename, 'rb')
+        self.lines = []
+        for start, end in regions:
+            fp.seek(start)
+            self.lines.extend([i for i in fp.read(end - start).decode().splitlines() if len(i.strip()) != 0 and i[0] != '#'])
         self.lineptr = 0
         fp.close()
+        loopnum = 0
 
         while 1:
             try: line = self._nextline().strip()
@@ -109,7 +415,7 @@ class StarFile(dict):
                 key = spl[0][1:]
 
                 if len(spl) == 2: # value on the same line
-                    if spl[1][0] in (",", '"'): self[key] = spl[1:-1] # we assume the last non-whitespace character is the ending delimeter
+                    if spl[1][0] in ("'", '"'): self[key] = spl[1][1:-1] # we assume the last non-whitespace character is the ending delimeter
                     else:
                         try: val = int(spl[1])
                         except:
@@ -134,31 +440,42 @@ class StarFile(dict):
                     else: raise Exception("StarFile: Key-value paier error. Matching value for %s not found." % key)
 
             elif line[:5].lower() == 'data_':
-                if len(self) > 0:
-                    print("WARNING: second data_block encountered in ", self.filename, ".Cannot deal with this at present. Second block ignored.")
-                    return
-                self.dataname = line[5:]
+                pass # header of the block being read, the buffer holds only this block
 
             elif line[:5].lower() == 'loop_':
                 loop = []
-                self.loops.append(loop) # add it to the list of loops immediately then update it as we go
 
                 # First we read the parameter names for the loop
                 while 1:
-                    line2 = self._nextline().strip()
+                    try: line2 = self._nextline().strip()
+                    except: break
                     if line2[0] == '_':
                         loop.append(line2.split()[0][1:])
-                        self[loop[-1]] = [] # this will hold the data values when we read them
                     else: break
                 self.lineptr -= 1
 
+                # Only the requested columns are kept, and only their values get converted
+                keep = [i for i in range(len(loop)) if self.columns is None or loop[i] in self.columns]
+                self.loops.append([loop[i] for i in keep])
+                for i in keep: self[loop[i]] = [] # this will hold the data values when we read them
+
+                loopinfo = info['loops'][loopnum]
+                loopnum += 1
+                if self.columnar and self.nproc > 1 and loopinfo['end'] - loopinfo['start'] > self.parallel_threshold:
+                    self.update(_readcolumnsparallel(self.filename, loopinfo['start'], loopinfo['end'], loop, matcher, self.columns, self.nproc))
+                    continue
+                if self.columnar:
+                    # Convert the data lines of the loop a whole column at a time
+                    self.update(_readcolumns(loop, _iterlines(self.filename, loopinfo['start'], loopinfo['end'], COLUMNAR_BATCH_ROWS), matcher, self.columns))
+                    continue
+
                 # Now we read the actual loop data elements
                 vals = []
                 while 1:
                     try: line2 = self._nextline().strip()
                     except: break
 
-                    if line[2] == '_' or line2.lower()[:5] == 'loop_': break
+                    if not _isdata(line2): break
                     elif line2[0] == ';':
                         val = line2[0][1:]
                         while 1:
@@ -166,9 +483,9 @@ class StarFile(dict):
                             if line2[0] == ';':
                                 break
                             val += line2
-                        vals.append(val)
+                        vals.append((val,))
                     else:
-                        vals.extend([goodval(i) for i in matcher.findall(line2)])
+                        vals.extend(matcher.findall(line2))
                         if len(vals) < len(loop): # we may need to read multiple lines to get enough values
                             continue
                         if len(vals) > len(loop):
@@ -177,7 +494,7 @@ class StarFile(dict):
                             print(len(loop), loop)
                             print(len(vals), vals)
                             break
-                        for i in range(len(vals)): self[loop[i]].append(vals[i])
+                        for i in keep: self[loop[i]].append(goodval(vals[i]))
                         vals = []
 
                 self.lineptr -= 1
@@ -186,10 +503,152 @@ class StarFile(dict):
                 print("StarFile: Unknown content on line :", line)
                 break
 
+    def iterloop(self, keys, batch_size = 0):
+        """Generator streaming the rows of the first loop in the file containing all of the given keys.
+        Each row is yielded as a tuple of values in the same order as keys, and only those values are converted.
+        If batch_size is nonzero, lists of up to batch_size rows are yielded instead of single rows.
+        The file is read line by line, so memory use is independent of the size of the loop. The contents
+        of the dictionary are not used or modified."""
+
+        matcher = re.compile("""("[^"]+")|('[^']+')|([^\s]+)""")
+
+        loop = None     # parameter names of the loop currently being scanned
+        cols = None     # positions of the requested keys once a matching loop is found
+        vals = []
+        batch = []
+
+        fp = open(self.filename, 'r')
+        try:
+            for line in fp:
+                line = line.strip()
+                if len(line) == 0 or line[0] == '#': continue
+
+                if cols is None:
+                    # Look for the header of a loop containing all of the keys
+                    if line[:5].lower() == 'loop_':
+                        loop = []
+                    elif loop is not None and line[0] == '_':
+                        loop.append(line.split()[0][1:])
+                    elif loop:
+                        # first data line after a loop header
+                        if all(key in loop for key in keys):
+                            cols = [loop.index(key) for key in keys]
+                        else:
+                            loop = None
+                    if cols is None: continue
+
+                # Now we are in the data section of the matching loop
+                if line[0] == '_' or line[:5].lower() in ('loop_', 'data_'): break
+                elif line[0] == ';':
+                    val = line[1:]
+                    while 1:
+                        line2 = fp.readline()
+                        if len(line2) == 0: raise Exception("StarFile: Error found parsing multi-line string value in loop")
+                        if line2[0] == ';': break
+                        val += line2
+                    vals.append(val)
+                elif '"' in line or "'" in line:
+                    vals.extend([max(i) for i in matcher.findall(line)])
+                else:
+                    vals.extend(line.split())
+
+                if len(vals) < len(loop): # we may need to read multiple lines to get enough values
+                    continue
+                if len(vals) > len(loop):
+                    print("Mismatch")
+                    print(line)
+                    print(len(loop), loop)
+                    print(len(vals), vals)
+                    break
+
+                row = tuple([_convert(vals[i]) for i in cols])
+                vals = []
+                if batch_size:
+                    batch.append(row)
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+                else:
+                    yield row
+
+            if batch: yield batch
+        finally:
+            fp.close()
+
     def writefile(self, filename = None):
-        """Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in."""
+        """Writes the contents of the current dictionary back to disk using either the existing filename, or an alternative name passed in.
+        Only the data block held in the dictionary is written. Use writestar() to write several blocks to one file."""
+
+        if filename is None: filename = self.filename
+        dataname = getattr(self, 'dataname', self.block)
+        writestar(filename, {dataname if dataname is not None else '': self})
+
+def _formatcolumn(values):
+    """Formats a whole column of loop values to an array of strings"""
+    if isinstance(values, EncodedColumn):
+        # format each distinct string once, then expand by the codes
+        return _formatcolumn(values.categories)[values.codes]
+
+    col = np.asarray(values)
+    if col.dtype.kind == 'f': return np.char.mod('%12.6f', col)
+    if col.dtype.kind in 'iub': return np.char.mod('%12d', col.astype(np.int64))
+    if col.dtype.kind == 'S': col = np.char.decode(col)
+    col = col.astype(str)
+
+    # strings containing whitespace must be quoted, unless they already are
+    needs_quotes = np.array([len(val) == 0 or (len(val.split()) != 1 and val[0] not in ('"', "'")) for val in col], dtype = bool)
+    if needs_quotes.any():
+        col = np.where(needs_quotes, np.char.add(np.char.add('"', col), '"'), col)
+    return col
+
+def _formatvalue(val):
+    """Formats a single key/value pair value"""
+    if isinstance(val, (float, np.floating)): return '%.6f' % val
+    val = str(val)
+    if '\n' in val: return '\n;%s\n;' % val
+    if len(val) == 0 or (len(val.split()) != 1 and val[0] not in ('"', "'")): return '"%s"' % val
+    return val
+
+def writestar(filename, blocks):
+    """Writes a STAR file. blocks is a dictionary of data block name (without 'data_') -> block, written in order.
+    Each block is a dictionary of key -> value: lists, NumPy arrays and EncodedColumns are written as loop columns,
+    anything else as a key/value pair. If the block has a 'loops' attribute (eg - a StarFile), it gives the keys of
+    each loop; otherwise all of the columns are written as a single loop. Columns are formatted as a whole, and rows
+    are written in batches of COLUMNAR_BATCH_ROWS."""
+
+    fp = open(filename, 'w')
+    for name, block in blocks.items():
+        fp.write('\ndata_%s\n\n' % name)
+
+        iscolumn = lambda val: isinstance(val, (list, tuple, np.ndarray, EncodedColumn))
+        loops = getattr(block, 'loops', None)
+        if not loops:
+            loops = [[key for key in block if iscolumn(block[key])]]
+        inloop = set(key for loop in loops for key in loop)
+
+        pairs = [key for key in block if key not in inloop and not iscolumn(block[key])]
+        for key in pairs:
+            fp.write('_%s %s\n' % (key, _formatvalue(block[key])))
+        if pairs: fp.write('\n')
+
+        for loop in loops:
+            loop = [key for key in loop if key in block]
+            if not loop: continue
+            nrows = len(block[loop[0]])
+            for key in loop:
+                if len(block[key]) != nrows:
+                    raise Exception("StarFile: loop keys %s and %s have different numbers of values" % (loop[0], key))
+
+            fp.write('loop_\n')
+            for i, key in enumerate(loop):
+                fp.write('_%s #%d\n' % (key, i + 1))
 
-        print("Sorry, writing not implemented yet.")
+            for start in range(0, nrows, COLUMNAR_BATCH_ROWS):
+                cols = [_formatcolumn(block[key][start:start + COLUMNAR_BATCH_ROWS]) for key in loop]
+                fp.write('\n'.join([' '.join(row) for row in zip(*cols)]))
+                fp.write('\n')
+            fp.write('\n')
+    fp.close()
                     
 
 
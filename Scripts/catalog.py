@@ -0,0 +1,336 @@
+######
+# SQLite catalog of the contents of the database.
+#
+# Listing the database used to mean listing every entry and job folder, reading each info.txt and
+# walking every folder for its size, which takes minutes on NFS with thousands of entries. The catalog
+# is updated as projects are parsed (see file_crawler.py) and holds, in Database/catalog.db:
+#   entries: entry name, source ('relion' or 'csparc') and project folder it was parsed from
+#   jobs: job folders of each entry, with their job type and number, particle, micrograph and missing
+#         micrograph counts, optics values and size in bytes
+#   micrographs: micrographs of each entry, with the path they were found at and their size in bytes
+#   missing_micrographs: micrographs of each job that could not be found
+#   entry_stats: rollups of each entry, updated as its jobs are added: number of jobs, particles,
+#                micrographs and missing micrographs, and the bytes of its jobs, micrographs and
+#                shared particle table
+#   watched_projects: project folders polled for new jobs by the watcher (see watcher.py), with their
+#                     source and the entry they are parsed into
+# along with the registry of the source micrographs (see micrograph_registry.py).
+# The GUI and command line list the database from these rollups, without walking the entry folders.
+#
+# Example usage: $catalog.py --jobs
+# A catalog is built from the entry folders the first time it is opened on an existing database.
+######
+
+import os
+import re
+import argparse
+import sqlite3
+from urllib.request import pathname2url
+from job_store import shared_dirs, open_job_store
+from micrograph_registry import MicrographRegistry
+from db_commit import TMP_PREFIX
+
+CATALOG_NAME = 'catalog.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    name TEXT PRIMARY KEY,
+    source TEXT,
+    project_dir TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    entry TEXT NOT NULL REFERENCES entries(name) ON DELETE CASCADE,
+    folder TEXT NOT NULL,
+    job_type TEXT NOT NULL,
+    job_number INTEGER,
+    num_particles INTEGER,
+    num_mics INTEGER,
+    voltage REAL,
+    cs REAL,
+    amp_contrast REAL,
+    pixel_size REAL,
+    bytes INTEGER,
+    num_missing INTEGER,
+    PRIMARY KEY (entry, folder)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_type ON jobs (entry, job_type, job_number);
+CREATE TABLE IF NOT EXISTS micrographs (
+    entry TEXT NOT NULL REFERENCES entries(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    source_path TEXT,
+    bytes INTEGER,
+    PRIMARY KEY (entry, name)
+);
+CREATE TABLE IF NOT EXISTS missing_micrographs (
+    entry TEXT NOT NULL REFERENCES entries(name) ON DELETE CASCADE,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (entry, folder, name)
+);
+CREATE TABLE IF NOT EXISTS entry_stats (
+    entry TEXT PRIMARY KEY REFERENCES entries(name) ON DELETE CASCADE,
+    num_jobs INTEGER,
+    num_particles INTEGER,
+    num_mics INTEGER,
+    num_missing INTEGER,
+    job_bytes INTEGER,
+    mic_bytes INTEGER,
+    shared_bytes INTEGER,
+    bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS watched_projects (
+    project_dir TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    entry TEXT NOT NULL
+);
+"""
+
+# Order in which the job types of an entry are preferred as training data
+SELECTION_HIERARCHY = {'relion': ['Refine3D', 'Select3D', 'Select2D'],
+                       'csparc': ['Homo', 'Hetero', 'Select2D']}
+
+def split_job_folder(folder):
+    # Returns the job type and number of a job folder in the database, eg - Refine3D_job035 -> ('Refine3D', 35)
+    job_type, _, job_name = folder.partition('_')
+    numbers = re.findall(r'\d+', job_name)
+    return job_type, int(numbers[-1]) if numbers else None
+
+def folder_bytes(dir_path):
+    # Returns the total size of the files within a folder, without following symbolic links
+    total = 0
+    try:
+        for entry in os.scandir(dir_path):
+            if entry.is_dir(follow_symlinks = False):
+                total += folder_bytes(entry.path)
+            else:
+                total += entry.stat(follow_symlinks = False).st_size
+    except (NotADirectoryError, FileNotFoundError):
+        return os.lstat(dir_path).st_size if os.path.lexists(dir_path) else 0
+    except PermissionError:
+        return 0
+    return total
+
+def read_only_connection(db_loc = '../Database/'):
+    # Returns a read-only connection to the catalog of a database, eg - for the workers of a parallel crawl,
+    # which leave the writes to the catalog to the crawler (see file_crawler.parse_projects_parallel)
+    path = pathname2url(os.path.abspath(os.path.join(db_loc, CATALOG_NAME)))
+    return sqlite3.connect('file:%s?mode=ro' % path, uri = True, timeout = 60)
+
+class Catalog(object):
+    """
+    Catalog of a database folder. Can be used as a context manager, which closes the connection.
+    Rows are returned as sqlite3.Row objects, indexed by column name.
+    """
+
+    def __init__(self, db_loc = '../Database/'):
+        self.db_loc = db_loc
+        os.makedirs(db_loc, exist_ok = True)
+        path = os.path.join(db_loc, CATALOG_NAME)
+        is_new = not os.path.isfile(path)
+        # wait for other processes writing to the catalog rather than failing
+        self.conn = sqlite3.connect(path, timeout = 60)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+        self._migrate()
+        # source micrographs, shared by every entry of the database
+        self.registry = MicrographRegistry(self.conn)
+        if is_new:
+            self.rebuild()
+
+    def _migrate(self):
+        # Brings a catalog created by an earlier version up to date
+        columns = [row['name'] for row in self.conn.execute('PRAGMA table_info(jobs)')]
+        if 'num_missing' not in columns:
+            with self.conn:
+                self.conn.execute('ALTER TABLE jobs ADD COLUMN num_missing INTEGER')
+            # the missing micrographs of each job are read from its job store
+            for job in self.conn.execute('SELECT entry, folder FROM jobs').fetchall():
+                job_dir = os.path.join(self.db_loc, job['entry'], 'Particles', job['folder'])
+                missing_mics = open_job_store(job_dir).missing_mics if os.path.isdir(job_dir) else []
+                with self.conn:
+                    self.conn.execute('UPDATE jobs SET num_missing = ? WHERE entry = ? AND folder = ?',
+                            (len(missing_mics), job['entry'], job['folder']))
+                    self.conn.executemany('INSERT OR IGNORE INTO missing_micrographs VALUES (?, ?, ?)',
+                            [(job['entry'], job['folder'], name) for name in missing_mics])
+        # rollups of the entries catalogued before they existed
+        for row in self.conn.execute("""SELECT name FROM entries
+                WHERE name NOT IN (SELECT entry FROM entry_stats)""").fetchall():
+            self.update_entry_stats(row['name'], self._shared_bytes(row['name']))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_entry(self, name, source, project_dir = None):
+        # Adds an entry, replacing any previous entry with the same name along with its jobs and micrographs
+        with self.conn:
+            self.conn.execute('DELETE FROM entries WHERE name = ?', (name,))
+            self.conn.execute('INSERT INTO entries (name, source, project_dir) VALUES (?, ?, ?)',
+                    (name, source, project_dir))
+
+    def add_job(self, entry, folder, summary, num_bytes = None):
+        """
+        Adds a job folder of an entry, from the summary returned by ParticleTable.write, and the
+        micrographs it found. num_bytes is the size of the job folder, measured if not given.
+        """
+        if num_bytes is None:
+            num_bytes = folder_bytes(os.path.join(self.db_loc, entry, 'Particles', folder))
+        job_type, job_number = split_job_folder(folder)
+        metadata = summary['metadata']
+        missing_mics = summary.get('missing_mics', [])
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (entry, folder, job_type, job_number, summary['num_particles'], summary['num_mics'],
+                     metadata['voltage'], metadata['cs'], metadata['amp_contrast'], metadata['pixel_size'],
+                     num_bytes, len(missing_mics)))
+            self.conn.executemany('INSERT OR REPLACE INTO micrographs VALUES (?, ?, ?, ?)',
+                    [(entry, name, path, size) for name, path, size in summary.get('micrographs', [])])
+            self.conn.execute('DELETE FROM missing_micrographs WHERE entry = ? AND folder = ?', (entry, folder))
+            self.conn.executemany('INSERT OR IGNORE INTO missing_micrographs VALUES (?, ?, ?)',
+                    [(entry, folder, name) for name in missing_mics])
+        self.update_entry_stats(entry)
+
+    def update_job_bytes(self, entry):
+        # Measures again the size of every job folder and the shared particle table of an entry,
+        # eg - after its jobs were deduplicated
+        folders = [job['folder'] for job in self.jobs(entry)]
+        with self.conn:
+            for folder in folders:
+                self.conn.execute('UPDATE jobs SET bytes = ? WHERE entry = ? AND folder = ?',
+                        (folder_bytes(os.path.join(self.db_loc, entry, 'Particles', folder)), entry, folder))
+        self.update_entry_stats(entry, self._shared_bytes(entry))
+
+    def _shared_bytes(self, entry):
+        # all the generations of the shared table on disk, eg - as a dedup was interrupted
+        return sum(folder_bytes(folder) for _, folder in shared_dirs(os.path.join(self.db_loc, entry)))
+
+    def update_entry_stats(self, entry, shared_bytes = None):
+        """
+        Updates the rollups of an entry from the jobs and micrographs catalogued for it.
+        shared_bytes is the size of the shared particle table of the entry, kept from the previous rollup if not given.
+        """
+        jobs = self.conn.execute("""SELECT COUNT(*), COALESCE(SUM(num_particles), 0), COALESCE(SUM(bytes), 0)
+                FROM jobs WHERE entry = ?""", (entry,)).fetchone()
+        mics = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM micrographs WHERE entry = ?',
+                (entry,)).fetchone()
+        # micrographs missing for a job may have been found for another
+        num_missing = self.conn.execute("""SELECT COUNT(DISTINCT name) FROM missing_micrographs
+                WHERE entry = ? AND name NOT IN (SELECT name FROM micrographs WHERE entry = ?)""",
+                (entry, entry)).fetchone()[0]
+        if shared_bytes is None:
+            row = self.conn.execute('SELECT shared_bytes FROM entry_stats WHERE entry = ?', (entry,)).fetchone()
+            shared_bytes = row['shared_bytes'] if row is not None else 0
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO entry_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (entry, jobs[0], jobs[1], mics[0], num_missing, jobs[2], mics[1], shared_bytes,
+                     jobs[2] + mics[1] + shared_bytes))
+
+    def watch_project(self, project_dir, source, entry):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO watched_projects VALUES (?, ?, ?)',
+                    (os.path.abspath(project_dir), source, entry))
+
+    def unwatch_project(self, project_dir):
+        with self.conn:
+            self.conn.execute('DELETE FROM watched_projects WHERE project_dir = ?', (os.path.abspath(project_dir),))
+
+    def watched_projects(self):
+        return self.conn.execute('SELECT * FROM watched_projects ORDER BY project_dir').fetchall()
+
+    def remove_entry(self, name):
+        with self.conn:
+            self.conn.execute('DELETE FROM entries WHERE name = ?', (name,))
+
+    def entries(self):
+        # Returns all entries with their rollups (see entry_stats), eg - the total size in bytes of their
+        # jobs, micrographs and shared particle table under 'bytes'
+        return self.conn.execute("""SELECT e.*, s.num_jobs, s.num_particles, s.num_mics, s.num_missing,
+                    s.job_bytes, s.mic_bytes, s.shared_bytes, COALESCE(s.bytes, 0) AS bytes
+                FROM entries e LEFT JOIN entry_stats s ON s.entry = e.name ORDER BY e.name""").fetchall()
+
+    def entry(self, name):
+        return self.conn.execute('SELECT * FROM entries WHERE name = ?', (name,)).fetchone()
+
+    def jobs(self, entry, job_type = None):
+        # Returns the jobs of an entry, optionally only those of one job type
+        if job_type is None:
+            return self.conn.execute('SELECT * FROM jobs WHERE entry = ? ORDER BY job_type, job_number',
+                    (entry,)).fetchall()
+        return self.conn.execute('SELECT * FROM jobs WHERE entry = ? AND job_type = ? ORDER BY job_number',
+                (entry, job_type)).fetchall()
+
+    def latest_job(self, entry, job_type):
+        # Returns the job of an entry with the given type and the largest job number, or None
+        return self.conn.execute("""SELECT * FROM jobs WHERE entry = ? AND job_type = ?
+                ORDER BY job_number DESC LIMIT 1""", (entry, job_type)).fetchone()
+
+    def micrographs(self, entry):
+        return self.conn.execute('SELECT * FROM micrographs WHERE entry = ? ORDER BY name', (entry,)).fetchall()
+
+    def rebuild(self):
+        # Builds the catalog from the entry folders of the database, for databases parsed before the catalog existed
+        for name in sorted(os.listdir(self.db_loc)):
+            entry_path = os.path.join(self.db_loc, name)
+            particles_path = os.path.join(entry_path, 'Particles')
+            if not os.path.isdir(particles_path):
+                continue
+            markers = os.listdir(entry_path)
+            source = 'relion' if '.relion' in markers else 'csparc' if '.csparc' in markers else None
+            self.add_entry(name, source)
+
+            for folder in sorted(os.listdir(particles_path)):
+                job_dir = os.path.join(particles_path, folder)
+                # skip the temporary folders of interrupted parses
+                if folder.startswith(TMP_PREFIX) or not os.path.isfile(os.path.join(job_dir, 'data.txt')):
+                    continue
+                store = open_job_store(job_dir)
+                summary = {'num_particles': len(store), 'num_mics': store.num_micrographs, 'metadata': store.metadata,
+                           'missing_mics': store.missing_mics}
+                self.add_job(name, folder, summary)
+
+            # sizes of the micrographs, following the links to the files they were parsed from
+            mics_path = os.path.join(entry_path, 'Micrographs')
+            if os.path.isdir(mics_path):
+                rows = []
+                for mic in os.scandir(mics_path):
+                    source_path = os.path.realpath(mic.path) if mic.is_symlink() else None
+                    try:
+                        rows.append((name, mic.name, source_path, mic.stat().st_size))
+                    except OSError:
+                        pass
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO micrographs VALUES (?, ?, ?, ?)', rows)
+            self.update_entry_stats(name, self._shared_bytes(name))
+
+def format_size(num_bytes, factor = 1024, suffix = 'B'):
+    for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
+        if num_bytes < factor:
+            return '%.2f%s%s' % (num_bytes, unit, suffix)
+        num_bytes /= factor
+    return '%.2fY%s' % (num_bytes, suffix)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'List the entries of the database from its catalog.')
+    parser.add_argument('--db', default = '../Database/', help = 'Database folder')
+    parser.add_argument('--jobs', action = 'store_true', help = 'Also list the jobs of each entry')
+    args = parser.parse_args()
+
+    with Catalog(args.db) as catalog:
+        for entry in catalog.entries():
+            print('%s (%s): %d jobs, %d particles, %d micrographs, %d missing, %s' % (entry['name'], entry['source'],
+                    entry['num_jobs'] or 0, entry['num_particles'] or 0, entry['num_mics'] or 0,
+                    entry['num_missing'] or 0, format_size(entry['bytes'])))
+            if args.jobs:
+                for job in catalog.jobs(entry['name']):
+                    print('    %s: %d particles, %d micrographs, %d missing, %s' % (job['folder'], job['num_particles'],
+                            job['num_mics'], job['num_missing'] or 0, format_size(job['bytes'] or 0)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+######
+# Journal of the crawls of the file system for projects (see file_crawler.py).
+#
+# A crawl appends one JSON object per line to its journal as it goes, each with an 'event', the 'root'
+# folder of the crawl and a 'time':
+#   start, end: a crawl of the root folder began or finished. A crawl resuming another has 'resumed' set,
+#               and the events of the crawls it resumes still count, however many times it was interrupted
+#   dir: a folder was listed, with the types of project it is ('projects') and its sub-folders ('subdirs')
+#   job: a job of a project was parsed, or failed, with the time it took ('seconds') and the 'error'
+#   project: a project was parsed into an entry, failed, or was skipped as its entry was locked by
+#            another process, with the time it took and the error
+# When a crawl of a root folder is started while the journal holds a crawl of the same folder that did not
+# finish, the crawl resumes: folders already listed are not listed again, and projects already parsed
+# are skipped. Lines are only ever appended, so a crawl killed at any point loses at most one event.
+#
+# Example usage: $file_crawler.py /net/scratch/Structures --journal crawl.jsonl
+######
+
+import os
+import json
+import time
+
+class CrawlJournal(object):
+    """
+    Journal of the crawl of a root folder, appended to a JSONL file. Opening the journal starts a new crawl,
+    or resumes the last crawl of the root folder if it did not finish.
+    visited: sub-folder names and project types of the folders already listed, by folder
+    done_projects: project folders already parsed
+    """
+
+    def __init__(self, path, root_dir):
+        self.path = path
+        self.root = os.path.abspath(root_dir)
+        self.visited = {}
+        self.done_projects = set()
+        self.resumed = False
+
+        # events of the last crawl of the root folder
+        events = []
+        if os.path.isfile(path):
+            with open(path) as journal_f:
+                for line in journal_f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # line cut short by a crawl that was killed
+                        continue
+                    if event.get('root') != self.root:
+                        continue
+                    if event['event'] == 'start' and not event.get('resumed'):
+                        events = []
+                    events.append(event)
+
+        if events and events[-1]['event'] != 'end':
+            self.resumed = True
+            for event in events:
+                if event['event'] == 'dir':
+                    self.visited[event['path']] = (event['projects'], event['subdirs'])
+                elif event['event'] == 'project' and event['status'] == 'parsed':
+                    self.done_projects.add(event['path'])
+
+        self.journal_f = open(path, 'a')
+        self.record('start', resumed = self.resumed)
+
+    def record(self, event, **fields):
+        # Appends an event to the journal
+        fields.update(event = event, root = self.root, time = time.time())
+        self.journal_f.write(json.dumps(fields) + '\n')
+        self.journal_f.flush()
+
+    def record_dir(self, dir_path, project_types, subdirs):
+        self.record('dir', path = dir_path, projects = project_types, subdirs = [os.path.basename(subdir) for subdir in subdirs])
+
+    def listed(self, dir_path):
+        # Returns the (project types, sub-folders) of a folder listed by the crawl being resumed, or None
+        if dir_path not in self.visited:
+            return None
+        project_types, subdirs = self.visited[dir_path]
+        return project_types, [os.path.join(dir_path, subdir) for subdir in subdirs]
+
+    def close(self, finished = True):
+        # Closes the journal, recording that the crawl finished unless it was interrupted
+        if finished:
+            self.record('end')
+        self.journal_f.close()
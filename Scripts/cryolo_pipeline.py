@@ -16,6 +16,9 @@ import subprocess
 import shutil
 import warnings
 import argparse
+import numpy as np
+from EMAN2star import writestar
+from job_store import open_job_store
 
 
 def create_config_file(box_size, config_fname,
@@ -40,7 +43,8 @@ def train_model(config_fname):
 def convert_to_cryolo_training(particle_data_file, box_size, output_image_folder,
                                output_annot_folder):
     """
-    Converts the output of file_crawler.py's particle files 'data.txt' into
+    Converts the output of file_crawler.py's particle files 'data.txt' (read from the
+    job store of its job folder) into
     the box format used by Cryolo for training data. Also arranges the micrograph
     files in separate train_image folder.
     """
@@ -48,31 +52,23 @@ def convert_to_cryolo_training(particle_data_file, box_size, output_image_folder
         os.mkdir(output_image_folder)
     if not os.path.exists(output_annot_folder):
         os.mkdir(output_annot_folder)
-    with open(particle_data_file, 'r') as data_f:
-        all_data = data_f.read()
-        all_data = all_data.split('$')[:-1]
-
-        # the first element in the list would be particle metadata
-        for mic_data in all_data[1:]:
-            # list and filter func. used to get rid of empty strings just in case
-            mic_name = list(filter(None, mic_data.split('\n')))[0].split()[-1]
-            mic_path = os.path.normpath(os.path.join(particle_data_file, '../../../Micrographs/%s' % mic_name))
-            if os.path.exists(mic_path):
-                shutil.copy(mic_path, os.path.join(
-                    output_image_folder, mic_name), follow_symlinks=False)
-                box_file_path = os.path.join(
-                    output_annot_folder, '%s.box' % os.path.splitext(mic_name)[0])
-                with open(box_file_path, 'w') as box_f:
-                    # the first element in the list would be the micrograph name
-                    particle_data = list(filter(None, mic_data.split('\n')))[1:]
-                    for particle in particle_data:
-                        x, y = particle.split()
-                        x = round(float(x))
-                        y = round(float(y))
-                        box_f.write('{:<4d}\t{:<4d}\t{:3d}\t{:3d}\n'.format(x, y, box_size, box_size))
-            else:
-                warnings.warn('Micrographs folder is missing %s: particle data \
-                    related to it will not be used for training data.' % mic_name)
+    # particles are read from the job store of the job folder holding data.txt
+    job_dir = os.path.dirname(particle_data_file)
+    store = open_job_store(job_dir)
+    for mic_name, coords in store:
+        mic_path = os.path.normpath(os.path.join(job_dir, '../../Micrographs/%s' % mic_name))
+        if os.path.exists(mic_path):
+            shutil.copy(mic_path, os.path.join(
+                output_image_folder, mic_name), follow_symlinks=False)
+            box_file_path = os.path.join(
+                output_annot_folder, '%s.box' % os.path.splitext(mic_name)[0])
+            boxes = np.empty((len(coords), 4), dtype=int)
+            boxes[:, :2] = np.round(coords)
+            boxes[:, 2:] = box_size
+            np.savetxt(box_file_path, boxes, fmt='%-4d\t%-4d\t%3d\t%3d')
+        else:
+            warnings.warn('Micrographs folder is missing %s: particle data \
+                related to it will not be used for training data.' % mic_name)
 
 
 def cryolo_train_wrapper(job_folders=[], box_sizes=[], cryolo_output_folder='cryolo_training',
@@ -160,18 +156,26 @@ def generate_relion_files(ctf_mics_star_file, cryolo_picks_dir):
     with open(os.path.join('CryoloPick', 'coords_suffix_autopick.star'), 'w') as star_f:
         star_f.write('%s' % ctf_mics_star_file)
 
-    os.mkdir(os.path.join('CryoloPick', 'Movies'))
+    # Cryolo box files (lower-left corner, width, height) are converted into Relion coordinate
+    # STAR files holding the particle centres. Any other files are copied over as they are.
+    # Both are renamed with the '_autopick' suffix that Relion expects.
+    movies_dir = os.path.join('CryoloPick', 'Movies')
+    os.mkdir(movies_dir)
     for filename in os.listdir(cryolo_picks_dir):
         file_path = os.path.join(cryolo_picks_dir, filename)
-        if os.path.isfile(file_path):
-            shutil.copy(file_path, 'CryoloPick/Movies/')
-
-    for filename in os.listdir('CryoloPick/Movies/'):
-        old_f_path = os.path.join('CryoloPick/Movies/', filename)
+        if not os.path.isfile(file_path):
+            continue
         fname, ext = os.path.splitext(filename)
-        new_fname = fname + '_autopick' + ext
-        new_f_path = os.path.join('CryoloPick/Movies/', new_fname)
-        os.rename(old_f_path, new_f_path)
+        if ext == '.box':
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore') # micrographs without any picks have empty box files
+                boxes = np.loadtxt(file_path, ndmin=2)
+            boxes = boxes.reshape(-1, 4) if boxes.size == 0 else boxes
+            coords = {'rlnCoordinateX': boxes[:, 0] + boxes[:, 2] / 2,
+                      'rlnCoordinateY': boxes[:, 1] + boxes[:, 3] / 2}
+            writestar(os.path.join(movies_dir, fname + '_autopick.star'), {'': coords})
+        else:
+            shutil.copy(file_path, os.path.join(movies_dir, fname + '_autopick' + ext))
 
 
     
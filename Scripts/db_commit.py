@@ -0,0 +1,127 @@
+######
+# Atomic writes and locking of the entries of the database.
+#
+# A job folder is written in full to a temporary folder next to it, its files are flushed to disk, and it
+# is then renamed into place. An interrupted parse leaves at most a temporary folder, never a job folder
+# with half of its files, and the temporary folders left behind are removed the next time the entry is
+# written. Small files rewritten in place, like the headers of job stores and the manifest of an entry,
+# are written to a temporary file then renamed over the file.
+#
+# Each entry has an advisory lock, held by the process writing into it, so several crawlers can fill the
+# database at once: a crawler skips the projects whose entry is locked by another. The locks are files in
+# the .locks folder of the database, locked with flock, so they are released if a crawler dies.
+######
+
+import os
+import json
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+LOCK_FOLDER = '.locks'
+# prefix of the temporary folders that are renamed into place once written
+TMP_PREFIX = '.tmp_'
+
+def fsync_path(path):
+    # Flushes a file, or the entries of a folder, to disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_tree(dir_path):
+    # Flushes every file and folder under a folder to disk, without following symbolic links
+    for root, dirs, files in os.walk(dir_path):
+        for fname in files:
+            if not os.path.islink(os.path.join(root, fname)):
+                fsync_path(os.path.join(root, fname))
+        fsync_path(root)
+
+def atomic_write_json(path, obj, **kwargs):
+    # Writes obj as JSON to path, replacing the file at once. kwargs are passed on to json.dump.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_path(os.path.dirname(os.path.abspath(path)))
+
+@contextmanager
+def atomic_dir(dir_path):
+    """
+    Context manager yielding a temporary folder to write the contents of dir_path into. When the block
+    exits without error, the folder is flushed to disk and renamed to dir_path, replacing any folder
+    already there. If the block raises, the temporary folder is removed and dir_path is left untouched.
+    """
+    parent, name = os.path.split(os.path.normpath(dir_path))
+    tmp_path = os.path.join(parent, '%s%s.%d' % (TMP_PREFIX, name, os.getpid()))
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    try:
+        yield tmp_path
+        fsync_tree(tmp_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        raise
+
+    if os.path.isdir(dir_path):
+        # a folder cannot be renamed over another, so the previous folder is moved away first
+        old_path = os.path.join(parent, '%s%s.%d.old' % (TMP_PREFIX, name, os.getpid()))
+        os.rename(dir_path, old_path)
+        os.rename(tmp_path, dir_path)
+        shutil.rmtree(old_path, ignore_errors = True)
+    else:
+        os.rename(tmp_path, dir_path)
+    fsync_path(parent)
+
+def remove_partial_writes(dir_path):
+    # Removes the temporary folders and files left in a folder by interrupted writes.
+    # Only call it while holding the lock of the entry the folder belongs to.
+    if not os.path.isdir(dir_path):
+        return
+    for entry in os.scandir(dir_path):
+        if entry.name.startswith(TMP_PREFIX) and entry.is_dir(follow_symlinks = False):
+            shutil.rmtree(entry.path, ignore_errors = True)
+        elif entry.name.endswith('.tmp') and entry.is_file(follow_symlinks = False):
+            os.remove(entry.path)
+
+class EntryLock(object):
+    """
+    Advisory lock of an entry folder of the database, held by the process writing into the entry.
+    Used as a context manager, it waits for the lock.
+    """
+
+    def __init__(self, entry_path):
+        db_loc, name = os.path.split(os.path.normpath(entry_path))
+        lock_dir = os.path.join(db_loc, LOCK_FOLDER)
+        os.makedirs(lock_dir, exist_ok = True)
+        self.path = os.path.join(lock_dir, '%s.lock' % name)
+        self.lock_f = None
+
+    def acquire(self, blocking = True):
+        # Locks the entry, and returns whether it was locked. If blocking is False, returns False at once
+        # if another process holds the lock.
+        lock_f = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lock_f.close()
+            return False
+        self.lock_f = lock_f
+        return True
+
+    def release(self):
+        if self.lock_f is not None:
+            fcntl.flock(self.lock_f, fcntl.LOCK_UN)
+            self.lock_f.close()
+            self.lock_f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+######
+# Deduplication of the particles of the jobs of a database entry.
+#
+# The ManualPick, Select2D, Select3D and Refine3D (or Homo/Hetero) jobs of a project mostly hold the same
+# physical particles, which were stored once per job. dedup_entry matches the particles of all jobs of
+# an entry, and keeps each physical particle once in a shared particle table (a job store in the
+# SharedParticles.<generation> folder of the entry). Each job is then stored as a membership bitmap over the
+# shared table (see job_store.write_job_reference). The info.txt and data.txt export of each job is unchanged.
+#
+# Running it again as jobs are added writes a new generation of the shared table and of the bitmaps, and
+# switches the jobs to it once all of them are written. If interrupted, each job still refers to a complete
+# generation, and the next run deduplicates the entry again.
+#
+# Particles of different jobs are the same particle when they are on the same micrograph and within
+# a distance tolerance (in pixels) of each other. Candidates are found with a spatial hash grid of cells
+# the size of the tolerance, so only the particles in the 3x3 neighbouring cells of a particle are compared.
+#
+# Example usage: $dedup.py ../Database/EMPIAR-10117 --tolerance 5
+######
+
+import os
+import shutil
+import argparse
+import numpy as np
+from job_store import SHARED_FOLDER, STORE_ARRAYS, shared_dirs, has_job_store, open_job_store, write_job_store, \
+        write_job_membership, write_job_reference
+from spatial_index import cell_keys
+from particle_table import group_by_micrograph
+from db_commit import TMP_PREFIX, EntryLock, atomic_dir
+
+DEFAULT_TOLERANCE = 5.0
+
+def _candidate_pairs(ref_codes, ref_coords, codes, coords, tolerance):
+    # Returns (particle, reference particle, squared distance) for all pairs on the same micrograph within tolerance
+    ref_keys = cell_keys(ref_codes, np.floor(ref_coords / tolerance).astype(np.int64))
+    ref_order = np.argsort(ref_keys, kind = 'stable')
+    ref_keys = ref_keys[ref_order]
+    cells = np.floor(coords / tolerance).astype(np.int64)
+
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = cell_keys(codes, cells + np.array([dx, dy]))
+            lo = np.searchsorted(ref_keys, keys, side = 'left')
+            num = np.searchsorted(ref_keys, keys, side = 'right') - lo
+            particles = np.repeat(np.arange(len(codes)), num)
+            # position of each pair within the run of reference particles in the cell
+            within = np.arange(len(particles)) - np.repeat(np.cumsum(num) - num, num)
+            refs = ref_order[np.repeat(lo, num) + within]
+            pairs.append((particles, refs))
+
+    particles = np.concatenate([pair[0] for pair in pairs])
+    refs = np.concatenate([pair[1] for pair in pairs])
+    dist2 = np.sum((coords[particles] - ref_coords[refs]) ** 2, axis = 1)
+    close = dist2 <= tolerance ** 2
+    return particles[close], refs[close], dist2[close]
+
+def match_particles(ref_codes, ref_coords, codes, coords, tolerance = DEFAULT_TOLERANCE):
+    """
+    Matches particles to reference particles on the same micrograph within tolerance of each other.
+    Each reference particle is matched to at most one particle, so distinct particles of a job stay distinct.
+    ref_codes, codes: micrograph of each particle, as codes into the same table of micrographs
+    ref_coords, coords: (N, 2) particle coordinates
+    Returns the index of the matching reference particle for each particle, or -1 if there is none.
+    """
+    matched = np.full(len(codes), -1, dtype = np.int64)
+    if len(ref_codes) == 0 or len(codes) == 0:
+        return matched
+
+    particles, refs, dist2 = _candidate_pairs(ref_codes, ref_coords, codes, coords, tolerance)
+    # closest pairs first
+    order = np.argsort(dist2, kind = 'stable')
+    particles, refs = particles[order], refs[order]
+    ref_used = np.zeros(len(ref_codes), dtype = bool)
+    while len(particles):
+        # each particle takes its closest reference particle, and each reference particle its closest particle
+        first = np.unique(particles, return_index = True)[1]
+        # in order of distance, so a reference particle wanted by several particles goes to the closest one
+        first = np.sort(first)
+        first = first[np.unique(refs[first], return_index = True)[1]]
+        matched[particles[first]] = refs[first]
+        ref_used[refs[first]] = True
+        # the pairs left can still match particles to their next closest reference particle
+        left = (matched[particles] < 0) & ~ref_used[refs]
+        particles, refs = particles[left], refs[left]
+
+    return matched
+
+def needs_dedup(entry_path):
+    # Returns whether an entry has jobs storing their own particles, eg - as its last parse was interrupted
+    # before its jobs were deduplicated, or more than one generation of shared table, as its last dedup was
+    particles_path = os.path.join(entry_path, 'Particles')
+    if not os.path.isdir(particles_path):
+        return False
+    if len(shared_dirs(entry_path)) > 1:
+        return True
+    return any(os.path.isfile(os.path.join(particles_path, folder, STORE_ARRAYS['coords']))
+               for folder in os.listdir(particles_path) if not folder.startswith(TMP_PREFIX))
+
+def dedup_entry(entry_path, tolerance = DEFAULT_TOLERANCE):
+    """
+    Deduplicates the particles of all the jobs of an entry into a shared particle table, and stores
+    each job as a membership bitmap over it. Can be run again as jobs are added to an entry.
+    Returns the total number of particles of the jobs, and the number of distinct particles kept.
+    The entry should be locked by the caller (see db_commit.EntryLock).
+    """
+    particles_path = os.path.join(entry_path, 'Particles')
+    job_dirs = [os.path.join(particles_path, folder) for folder in sorted(os.listdir(particles_path))
+                if not folder.startswith(TMP_PREFIX) and (has_job_store(os.path.join(particles_path, folder)) or
+                os.path.isfile(os.path.join(particles_path, folder, 'data.txt')))]
+    if not job_dirs:
+        return 0, 0
+
+    # read the particles of every job into memory, as the shared table they may reference is replaced
+    jobs = []
+    for job_dir in job_dirs:
+        store = open_job_store(job_dir)
+        jobs.append((job_dir, store.metadata, store.missing_mics,
+                     np.array(store.micrographs), np.diff(store.offsets), np.concatenate([coords for mic, coords in store])
+                     if store.num_micrographs else np.empty((0, 2), dtype = np.float32)))
+        # release the memory-mapped arrays before the older shared tables are removed
+        del store
+
+    micrographs = np.unique(np.concatenate([job[3] for job in jobs]))
+    shared_codes = np.empty(0, dtype = np.int64)
+    shared_coords = np.empty((0, 2), dtype = np.float32)
+    memberships = []
+    for job_dir, metadata, missing_mics, mics, counts, coords in jobs:
+        codes = np.repeat(np.searchsorted(micrographs, mics), counts)
+        matched = match_particles(shared_codes, shared_coords, codes, coords, tolerance)
+        # particles without a match are new physical particles
+        new = np.flatnonzero(matched < 0)
+        matched[new] = len(shared_codes) + np.arange(len(new))
+        shared_codes = np.concatenate((shared_codes, codes[new]))
+        shared_coords = np.concatenate((shared_coords, coords[new]))
+        memberships.append(matched)
+
+    # the shared table is stored grouped by micrograph, like the table of a job
+    present, order, bounds = group_by_micrograph(shared_codes, len(micrographs))
+    rank = np.empty(len(order), dtype = np.int64)
+    rank[order] = np.arange(len(order))
+
+    # the jobs keep their current table until the new generation and all its bitmaps are written
+    old_dirs = shared_dirs(entry_path)
+    generation = max([generation for generation, folder in old_dirs] + [0]) + 1
+    shared_dir = os.path.join(entry_path, '%s.%d' % (SHARED_FOLDER, generation))
+    missing_mics = sorted(set(mic for job in jobs for mic in job[2]))
+    with atomic_dir(shared_dir) as tmp_dir:
+        write_job_store(tmp_dir, micrographs[present], shared_coords[order], bounds, jobs[0][1], missing_mics)
+
+    job_memberships = []
+    for (job_dir, metadata, missing_mics, mics, counts, coords), matched in zip(jobs, memberships):
+        membership = np.zeros(len(order), dtype = bool)
+        membership[rank[matched]] = True
+        write_job_membership(job_dir, membership, generation)
+        job_memberships.append(membership)
+
+    for (job_dir, metadata, missing_mics, mics, counts, coords), membership in zip(jobs, job_memberships):
+        write_job_reference(job_dir, shared_dir, membership, metadata, missing_mics, generation)
+
+    for _, folder in old_dirs:
+        shutil.rmtree(folder)
+
+    return sum(len(matched) for matched in memberships), len(order)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Deduplicate the particles of the jobs of database entries.')
+    parser.add_argument('entries', nargs = '+', help = 'Entry folders in the database')
+    parser.add_argument('--tolerance', type = float, default = DEFAULT_TOLERANCE,
+            help = 'Distance in pixels under which particles of different jobs are the same particle')
+    args = parser.parse_args()
+
+    for entry_path in args.entries:
+        with EntryLock(entry_path):
+            num_particles, num_shared = dedup_entry(entry_path, args.tolerance)
+        print('%s: %d particles in jobs, %d distinct particles' % (entry_path, num_particles, num_shared))
+
+if __name__ == '__main__':
+    main()
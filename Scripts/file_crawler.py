@@ -1,8 +1,22 @@
 import os
-import sys
 import re
 import json
+import time
+import warnings
+import hashlib
+import functools
+import multiprocessing
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from parse_particles import parse_particles_project_folder
+from EMAN2star import PARALLEL_THRESHOLD
+from catalog import Catalog, SELECTION_HIERARCHY, read_only_connection
+from micrograph_registry import MicrographRegistry
+from dedup import dedup_entry, needs_dedup
+from manifest import Manifest
+from db_commit import EntryLock, atomic_dir, remove_partial_writes
+from crawl_journal import CrawlJournal
+from relion_pipeline import RelionPipeline, process_type
 
 # Find files ending with the extensions in the list and
 # returns a list of paths to such files within the given
@@ -24,18 +38,53 @@ def find_file_with_extensions(dir_path, extensions=[]):
 
     return file_list
 
+DB_LOC = '../Database/'
+
+# Files found in every Relion and CSparc project folder
+RELION_MARKERS = ['default_pipeline.star', '.relion_display_gui_settings']
+CSPARC_MARKERS = ['job_manifest.json', 'workspaces.json', 'project.json']
+
+# Marker file written by Relion in a job folder once the job finished successfully
+RELION_SUCCESS_MARKER = 'RELION_JOB_EXIT_SUCCESS'
+# Status of a CryoSparc job in its job.json once it finished successfully
+CSPARC_COMPLETED_STATUS = 'completed'
+
+# Types of the Relion jobs holding particles, in the order they are parsed:
+# (1) Manually picked particles (2) Particles of selected 2D or 3D classes (3) Particles from 3D refinement
+RELION_JOB_TYPES = ['ManualPick', 'Select', 'Refine3D']
+# Prefix of the job folder in the entry of a Relion Select job, by the type of job it selects from
+RELION_SELECT_FOLDERS = {'Class2D': 'Select2D', 'Class3D': 'Select3D'}
+
+# Jobs parsed from Cryosparc projects, as (prefix of their job folder in the entry, job types), in the order they are parsed:
+# (1) Manually picked particles (2) Particles of selected 2D classes
+# (3) Particles from heterogeneous refinement (4) Particles from homogeneous refinement
+CSPARC_JOB_SELECTIONS = [('ManualPick', ['manual_picker_particles']),
+                         ('Select2D', ['select_2D']),
+                         ('Hetero', ['hetero_refine']),
+                         ('Homo', ['homo_refine', 'homo_refine_new'])]
+
+# Number of folders listed at once when searching for projects
+DEFAULT_CRAWL_THREADS = 16
+# Number of processes parsing jobs in parallel, by default one per core
+DEFAULT_NUM_WORKERS = os.cpu_count() or 1
+
+# Returns the types of project ('relion', 'csparc') a folder is, from the names of the files in it
+def project_types(fnames):
+    fnames = set(fnames)
+    types = []
+    if all(fname in fnames for fname in RELION_MARKERS):
+        types.append('relion')
+    if all(fname in fnames for fname in CSPARC_MARKERS):
+        types.append('csparc')
+    return types
+
 # Checks if a folder is a relion project folder
 def is_relion_project(dir_path):
     """
     All Relion project folders have the default_pipeline.star and 
     the .relion_display_gui_settings files.
     """
-    files = ['default_pipeline.star', '.relion_display_gui_settings']
-    for fname in files:
-        if fname not in os.listdir(dir_path):
-            return False
-
-    return True
+    return 'relion' in project_types(os.listdir(dir_path))
 
 # Checks if a folder is a CSPARC project folder
 def is_csparc_project(dir_path):
@@ -43,36 +92,254 @@ def is_csparc_project(dir_path):
     ALL CSparc project folders have settings and metadata files that identifies
     them as a CSparc project.
     """
-    files = ['job_manifest.json', 'workspaces.json', 'project.json']
-    for fname in files:
-        if fname not in os.listdir(dir_path):
-            return False
+    return 'csparc' in project_types(os.listdir(dir_path))
+
+# Checks if a Relion job finished successfully
+def relion_job_finished(job_dir_path):
+    return os.path.isfile(os.path.join(job_dir_path, RELION_SUCCESS_MARKER))
+
+# Checks if a CryoSparc job finished successfully, from the status in its job.json
+def csparc_job_finished(job_dir_path):
+    return read_csparc_job(job_dir_path)[1] == CSPARC_COMPLETED_STATUS
+
+# Lists a folder once, returning the folder, the types of project it is and, if it is not a project, its sub-folders
+def _scan_dir(dir_path):
+    try:
+        with os.scandir(dir_path) as it:
+            entries = list(it)
+    except OSError:
+        # unreadable folders are skipped
+        return dir_path, [], []
+    types = project_types(entry.name for entry in entries)
+    if types:
+        # a project is not searched further, the jobs in it are not projects of their own
+        return dir_path, types, []
+    subdirs = []
+    for entry in entries:
+        try:
+            # symbolic links are not followed, so folders linked from several places are only searched once
+            if entry.is_dir(follow_symlinks = False):
+                subdirs.append(entry.path)
+        except OSError:
+            pass
+    return dir_path, types, subdirs
 
-    return True
+def find_cryoem_projects(root_dir, num_threads = DEFAULT_CRAWL_THREADS, journal = None):
+    """
+    Searches a folder tree for Relion and CSparc projects, yielding (project folder, project type) as they are found.
+    Every folder is listed once, by a pool of num_threads threads, and the folders within projects are not listed.
+    If a CrawlJournal is given, the folders listed are recorded in it, and the folders listed by the crawl
+    it resumes are not listed again.
+    """
+    with ThreadPoolExecutor(max_workers = num_threads) as executor:
+        to_scan = [os.path.abspath(root_dir)]
+        pending = set()
+        while to_scan or pending:
+            for dir_path in to_scan:
+                listed = journal.listed(dir_path) if journal is not None else None
+                if listed is None:
+                    pending.add(executor.submit(_scan_dir, dir_path))
+                    continue
+                # listed before the crawl was resumed
+                types, subdirs = listed
+                for project_type in types:
+                    yield dir_path, project_type
+                to_scan.extend(subdirs)
+            to_scan = []
+            if not pending:
+                break
 
-# Recursively search starting from a root directory for Relion and CSparc
-# projects to parse them and add their particle data to a database
-def parse_particles_cryoem_projects(root_dir):
-    for root, subdirs, files in os.walk(root_dir):
-        if is_relion_project(root):
-            try:
-                parse_relion_project(root, os.path.basename(os.path.normpath(root)))
-            except:
-                # Do nothing in case an exception is triggered,
-                # there can be various reasons as to an exception.
-                # Many parameters missing will cause an exception of their own.
-                # In the future, might wanna implement more detailed error
-                # or warnings about which parameters are missing.
-                pass
-        if is_csparc_project(root):
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                dir_path, types, subdirs = future.result()
+                if journal is not None:
+                    journal.record_dir(dir_path, types, subdirs)
+                for project_type in types:
+                    yield dir_path, project_type
+                to_scan.extend(subdirs)
+
+# Returns the description of an exception recorded in the crawl journal
+def _error_message(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+def _record_job(journal, entry_name, folder, particles_fp, status, seconds = None, error = None):
+    if journal is not None:
+        journal.record('job', entry = entry_name, folder = folder, source = particles_fp, status = status,
+                seconds = seconds, error = error)
+
+def _record_project(journal, project_dir, entry_name, status, seconds = None, error = None):
+    if error is not None:
+        print('Failed to parse the project %s: %s' % (project_dir, error))
+    if journal is not None:
+        journal.record('project', path = project_dir, entry = entry_name, status = status, seconds = seconds, error = error)
+
+# Search starting from a root directory for Relion and CSparc
+# projects to parse them and add their particle data to a database.
+# If num_workers is more than 1, the jobs of the projects are parsed by a pool of processes (see parse_projects_parallel).
+# If journal_fp is given, the progress of the crawl is recorded in that journal file (see crawl_journal.py),
+# and an interrupted crawl of root_dir resumes from it.
+# STAR files with particle tables of more than parallel_threshold bytes are each parsed with nproc processes.
+def parse_particles_cryoem_projects(root_dir, cache_dir = None, num_threads = DEFAULT_CRAWL_THREADS, num_workers = 1, journal_fp = None,
+        nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    journal = CrawlJournal(journal_fp, root_dir) if journal_fp else None
+    finished = False
+    try:
+        projects = find_cryoem_projects(root_dir, num_threads, journal)
+        if journal is not None:
+            projects = ((project_dir, project_type) for project_dir, project_type in projects
+                    if project_dir not in journal.done_projects)
+
+        if num_workers > 1:
+            parse_projects_parallel(projects, num_workers, cache_dir = cache_dir, journal = journal,
+                    nproc = nproc, parallel_threshold = parallel_threshold)
+        else:
+            for project_dir, project_type in projects:
+                parse_project = parse_relion_project if project_type == 'relion' else parse_csparc_project
+                with Catalog(DB_LOC) as catalog:
+                    entry_name = entry_name_for(project_dir, catalog)
+                start = time.time()
+                try:
+                    locked = parse_project(project_dir, entry_name, cache_dir = cache_dir, incremental = True, journal = journal,
+                            nproc = nproc, parallel_threshold = parallel_threshold) is False
+                    _record_project(journal, project_dir, entry_name, 'locked' if locked else 'parsed', time.time() - start)
+                except Exception as e:
+                    # a project that cannot be parsed is recorded, and the crawl goes on with the next project
+                    _record_project(journal, project_dir, entry_name, 'failed', time.time() - start, _error_message(e))
+        finished = True
+    finally:
+        if journal is not None:
+            journal.close(finished)
+
+class _EntryParse(object):
+    # State of an entry parsed by parse_projects_parallel: its lock and manifest, and the jobs not merged yet
+    def __init__(self, project_dir, entry_name, lock, manifest):
+        self.project_dir = project_dir
+        self.name = entry_name
+        self.lock = lock
+        self.manifest = manifest
+        self.num_pending = 0
+        self.parsed = False
+        self.failed = False
+        self.start = time.time()
+
+    def finish(self, journal):
+        # Releases the entry once all of its tasks are merged
+        self.lock.release()
+        _record_project(journal, self.project_dir, self.name, 'failed' if self.failed else 'parsed', time.time() - self.start)
+
+def parse_projects_parallel(projects, num_workers = DEFAULT_NUM_WORKERS, cache_dir = None, journal = None,
+        nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    """
+    Parses projects into the database (incrementally) on a pool of num_workers processes.
+    projects: iterable of (project folder, project type), eg - from find_cryoem_projects
+    Each job folder, and the deduplication of each entry once all of its jobs are parsed, is a task of the
+    pool. The job folders are written by the workers, and this process is the only one writing to the
+    catalog and manifests, merging the result of each task as it completes. Projects are dispatched as
+    they are found, so the workers start before the search for projects ends.
+    journal: CrawlJournal recording the outcome of each job and project, if given
+    nproc: number of processes each worker parses the particle tables of more than parallel_threshold bytes with
+    """
+    # The workers are started by a forkserver: forking this process, which holds an SQLite connection and runs
+    # the threads searching for projects, can deadlock the workers.
+    mp_context = multiprocessing.get_context('forkserver')
+    with Catalog(DB_LOC) as catalog, ProcessPoolExecutor(max_workers = num_workers, mp_context = mp_context) as pool:
+        # task -> (entry, job folder, particle file), with no job folder for the deduplication of the entry
+        pending = {}
+        for project_dir, project_type in projects:
+            entry_name = entry_name_for(project_dir, catalog)
+            lock = _lock_entry(project_dir, entry_name)
+            if lock is None:
+                _record_project(journal, project_dir, entry_name, 'locked')
+                continue
+            entry = _EntryParse(project_dir, entry_name, lock, None)
             try:
-                parse_csparc_project(root, os.path.basename(os.path.normpath(root)))
-            except:
-                pass
+                entry.manifest = _open_entry(project_dir, entry_name, project_type, catalog, incremental = True)
+                jobs = _relion_jobs(project_dir) if project_type == 'relion' else _csparc_jobs(project_dir)
+            except Exception as e:
+                lock.release()
+                _record_project(journal, project_dir, entry_name, 'failed', time.time() - entry.start, _error_message(e))
+                continue
 
+            entry_path = os.path.join(DB_LOC, entry_name)
+            for particles_fp, folder in jobs:
+                sub_particles_path = os.path.join(entry_path, 'Particles', folder)
+                if os.path.isdir(sub_particles_path) and entry.manifest.is_current(folder, particles_fp):
+                    _record_job(journal, entry_name, folder, particles_fp, 'unchanged')
+                    continue
+                task = pool.submit(_parse_job_task, particles_fp, sub_particles_path,
+                        os.path.join(entry_path, 'Micrographs'), cache_dir, nproc, parallel_threshold)
+                pending[task] = (entry, folder, particles_fp)
+                entry.num_pending += 1
+            if entry.num_pending == 0:
+                _entry_jobs_merged(entry, pending, catalog, pool, journal)
+            _merge_tasks(pending, catalog, pool, journal, block = False)
+
+        while pending:
+            _merge_tasks(pending, catalog, pool, journal, block = True)
+
+# Task of parse_projects_parallel parsing a job folder. Returns the summary of the job, the time it took, and the
+# records of the micrograph registry to apply to the catalog. The micrographs are resolved against the registry
+# of the catalog, which the task only reads (see micrograph_registry.py).
+def _parse_job_task(particles_fp, sub_particles_path, mics_path, cache_dir = None, nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    start = time.time()
+    conn = read_only_connection(DB_LOC)
+    try:
+        registry = MicrographRegistry(conn, deferred = True)
+        summary = _parse_job_folder(particles_fp, sub_particles_path, mics_path, cache_dir = cache_dir, registry = registry,
+                nproc = nproc, parallel_threshold = parallel_threshold)
+    finally:
+        conn.close()
+    return summary, time.time() - start, registry.records
+
+# Merges the tasks of parse_projects_parallel that completed into the catalog and manifests.
+# If block is set, waits for at least one task to complete.
+def _merge_tasks(pending, catalog, pool, journal = None, block = True):
+    if not pending:
+        return
+    done, _ = wait(list(pending), timeout = None if block else 0, return_when = FIRST_COMPLETED)
+    for task in done:
+        entry, folder, particles_fp = pending.pop(task)
+        try:
+            result = task.result()
+            error = None
+        except Exception as e:
+            # a job that cannot be parsed is skipped, and the rest of its project is still parsed
+            result = None
+            error = _error_message(e)
+
+        if folder is None:
+            # the entry was deduplicated, and is complete
+            if error is not None:
+                entry.failed = True
+                print('Failed to deduplicate the entry %s: %s' % (entry.name, error))
+            catalog.update_job_bytes(entry.name)
+            entry.finish(journal)
+            continue
+
+        if result is not None:
+            summary, seconds, records = result
+            catalog.registry.apply(records)
+            catalog.add_job(entry.name, folder, summary)
+            entry.manifest.update(folder, particles_fp)
+            entry.parsed = True
+            _record_job(journal, entry.name, folder, particles_fp, 'parsed', seconds)
         else:
-            for dir_path in subdirs:
-                parse_particles_cryoem_projects(dir_path)
+            entry.failed = True
+            _record_job(journal, entry.name, folder, particles_fp, 'failed', error = error)
+        entry.num_pending -= 1
+        if entry.num_pending == 0:
+            _entry_jobs_merged(entry, pending, catalog, pool, journal)
+
+# Once all the jobs of an entry are merged, dispatches the deduplication of the entry if needed, or releases it
+def _entry_jobs_merged(entry, pending, catalog, pool, journal = None):
+    entry_path = os.path.join(DB_LOC, entry.name)
+    if entry.parsed or needs_dedup(entry_path):
+        pending[pool.submit(dedup_entry, entry_path)] = (entry, None, None)
+        return
+    if journal is not None and journal.resumed:
+        # the crawl may have been interrupted after deduplicating the entry, before measuring its jobs again
+        catalog.update_job_bytes(entry.name)
+    entry.finish(journal)
 
 
 
@@ -94,7 +361,6 @@ def _contains_particle_data(dir_path):
             if re.match('run_it[0-9]{3}_data.star', fname):
                 run_iters.append(fname)
         iter_nums = [re.findall('\d+', iteration)[0] for iteration in run_iters]
-        print(dir_path, iter_nums)
         max_run_iter = 'run_it%s_data.star' % '{0:0=3d}'.format(int(max(iter_nums)))
         return max_run_iter
 
@@ -113,97 +379,261 @@ def _contains_particle_data_csparc(dir_path):
 
     return ''
 
-# returns the type of a cryosparc job folder 
-def _csparc_job_type(job_dir_path):
+# returns the type and status of a cryosparc job folder, reading its job.json once
+def read_csparc_job(job_dir_path):
     if not os.path.isdir(job_dir_path):
-        return ''
+        return '', None
     if not re.match('J\d', os.path.basename(os.path.normpath(job_dir_path))):
-        return ''
+        return '', None
     json_path = os.path.join(job_dir_path, 'job.json')
-    with open(json_path) as json_f:
-        data = json.load(json_f)
-        if data['job_type'] == 'manual_picker':
-            # Manual Picking jobs can also be for micrographs, clarify this
-            if 'particles' in data['output_group_images']:
-                return 'manual_picker_particles'
-            else:
-                return 'manual_picker_mics'
-        return data['job_type']
-    
+    try:
+        with open(json_path) as json_f:
+            data = json.load(json_f)
+    except (IOError, ValueError):
+        # job folders without a readable job.json are not jobs that can be parsed
+        return '', None
+    job_type = data.get('job_type', '')
+    if job_type == 'manual_picker':
+        # Manual Picking jobs can also be for micrographs, clarify this
+        if 'particles' in data.get('output_group_images', {}):
+            job_type = 'manual_picker_particles'
+        else:
+            job_type = 'manual_picker_mics'
+    return job_type, data.get('status')
+
+# Returns an index of job type -> list of (job folder, status), in the order of the job folders, from a
+# dictionary of the (type, status) of each job folder of a Cryosparc project (see read_csparc_job)
+def csparc_job_index(jobs):
+    index = {}
+    for job_dir_path in sorted(jobs, key = os.path.basename):
+        job_type, status = jobs[job_dir_path]
+        if job_type:
+            index.setdefault(job_type, []).append((job_dir_path, status))
+    return index
+
+# Classifies the job folders of a Cryosparc project, reading the job.json of each job once
+def _csparc_job_index(dir_path):
+    job_dir_paths = [os.path.join(dir_path, dir_name) for dir_name in os.listdir(dir_path)]
+    return csparc_job_index(dict((job_dir_path, read_csparc_job(job_dir_path)) for job_dir_path in job_dir_paths))
+
+# Decorator for the functions parsing a project into an entry, called as parse(dir_path, entry_name, ...).
+# The entry is locked while it is parsed (see db_commit.py), and the project is skipped (returning False)
+# if another process is already writing into the entry. Partial writes left by an interrupted parse are removed first.
+def _entry_locked(parse):
+    @functools.wraps(parse)
+    def locked_parse(dir_path, entry_name, *args, **kwargs):
+        lock = _lock_entry(dir_path, entry_name)
+        if lock is None:
+            return False
+        try:
+            return parse(dir_path, entry_name, *args, **kwargs)
+        finally:
+            lock.release()
+    return locked_parse
+
+# Locks an entry and removes the partial writes left in it, or returns None if another process holds its lock
+def _lock_entry(dir_path, entry_name):
+    entry_path = os.path.join(DB_LOC, entry_name)
+    lock = EntryLock(entry_path)
+    if not lock.acquire(blocking = False):
+        print('Skipping %s: the entry %s is being written by another process.' % (dir_path, entry_name))
+        return None
+    remove_partial_writes(entry_path)
+    remove_partial_writes(os.path.join(entry_path, 'Particles'))
+    return lock
+
+# Returns whether an entry of the catalog holds another project than the project folder dir_path
+def _entry_of_other_project(dir_path, entry_name, catalog):
+    entry = catalog.entry(entry_name)
+    return entry is not None and entry['project_dir'] is not None and entry['project_dir'] != os.path.abspath(dir_path)
+
+# Returns the name of the entry of a project folder: the name of the folder, followed by a hash of its path
+# if an entry of that name already holds another project (eg - two projects both named 'proj')
+def entry_name_for(dir_path, catalog):
+    entry_name = os.path.basename(os.path.normpath(dir_path))
+    if _entry_of_other_project(dir_path, entry_name, catalog):
+        entry_name = '%s_%s' % (entry_name, hashlib.sha1(os.path.abspath(dir_path).encode()).hexdigest()[:8])
+    return entry_name
+
+# Creates the folders of an entry, and records it in the catalog of the database. Returns the manifest of the entry.
+def _open_entry(dir_path, entry_name, source, catalog, incremental = False):
+    entry_path = os.path.join(DB_LOC, entry_name)
+    if incremental and _entry_of_other_project(dir_path, entry_name, catalog):
+        # the jobs of another project would be written over the jobs of the entry
+        raise Exception('The entry %s holds the project %s, not %s.' % (entry_name, catalog.entry(entry_name)['project_dir'],
+                os.path.abspath(dir_path)))
+    # In incremental mode, the folders of an entry already in the database are reused
+    os.makedirs(entry_path, exist_ok = incremental)
+    os.makedirs(os.path.join(entry_path, 'Micrographs'), exist_ok = incremental)
+    os.makedirs(os.path.join(entry_path, 'Particles'), exist_ok = incremental)
+
+    # Create hidden file to identify the project as data parsed from a Relion or Cryosparc project
+    with open(os.path.join(entry_path, '.%s' % source), "w") as id_f:
+        pass
+
+    # Record the entry and each of its jobs in the catalog of the database
+    if not incremental or catalog.entry(entry_name) is None:
+        catalog.add_entry(entry_name, source, os.path.abspath(dir_path))
+    return Manifest(entry_path)
+
+# Store the particles shared by several jobs of an entry only once, once its jobs are parsed
+def _close_entry(entry_name, catalog):
+    dedup_entry(os.path.join(DB_LOC, entry_name))
+    catalog.update_job_bytes(entry_name)
+
+# Parse the particle file of a job into its job folder. The job folder is written in a temporary
+# folder, and only renamed into place once complete. Returns the summary of ParticleTable.write
+def _parse_job_folder(particles_fp, sub_particles_path, mics_path, cache_dir = None, registry = None,
+        nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    with atomic_dir(sub_particles_path) as tmp_path:
+        return parse_particles_project_folder(particles_fp = particles_fp,
+                data_output_dir = tmp_path,
+                mics_output_dir = mics_path,
+                cache_dir = cache_dir,
+                registry = registry,
+                nproc = nproc,
+                parallel_threshold = parallel_threshold)
+
+# Parse the particle file of a job into a job folder of an entry, and record it in the catalog
+# and manifest of the entry. Returns False if the job was skipped, as its particle file is unchanged
+# since it was last parsed into the job folder. The outcome is recorded in the crawl journal, if given.
+def _parse_job(particles_fp, folder, entry_name, catalog, manifest, cache_dir = None, journal = None,
+        nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    entry_path = os.path.join(DB_LOC, entry_name)
+    sub_particles_path = os.path.join(entry_path, 'Particles', folder)
+    if os.path.isdir(sub_particles_path) and manifest.is_current(folder, particles_fp):
+        _record_job(journal, entry_name, folder, particles_fp, 'unchanged')
+        return False
+
+    start = time.time()
+    try:
+        summary = _parse_job_folder(particles_fp, sub_particles_path, os.path.join(entry_path, 'Micrographs'),
+                cache_dir = cache_dir, registry = catalog.registry, nproc = nproc, parallel_threshold = parallel_threshold)
+    except Exception as e:
+        _record_job(journal, entry_name, folder, particles_fp, 'failed', time.time() - start, _error_message(e))
+        raise
+    catalog.add_job(entry_name, folder, summary)
+    manifest.update(folder, particles_fp)
+    _record_job(journal, entry_name, folder, particles_fp, 'parsed', time.time() - start)
+    return True
+
+# Returns the jobs of a Cryosparc project folder to parse, as (particle file, job folder in the entry).
+# If finished_only is set, only the jobs that finished successfully are returned.
+# job_index: index of the job folders of the project (see csparc_job_index), read from the job folders if not given
+def _csparc_jobs(dir_path, finished_only = False, job_index = None):
+    index = _csparc_job_index(dir_path) if job_index is None else job_index
+    jobs = []
+    for folder_prefix, job_types in CSPARC_JOB_SELECTIONS:
+        for job_type in job_types:
+            for job_dir_path, status in index.get(job_type, []):
+                if finished_only and status != CSPARC_COMPLETED_STATUS:
+                    continue
+                particles_fname = _contains_particle_data_csparc(job_dir_path)
+                if particles_fname:
+                    jobs.append((os.path.join(job_dir_path, particles_fname), '%s_%s' % (folder_prefix, os.path.basename(job_dir_path))))
+
+    return jobs
 
 # Parse a Cryosparc project folder and save to disk its particle data
-def parse_csparc_project(dir_path, entry_name):
+@_entry_locked
+def parse_csparc_project(dir_path, entry_name, cache_dir = None, incremental = False, journal = None, finished_only = False,
+        nproc = 1, parallel_threshold = PARALLEL_THRESHOLD, job_index = None):
     """
     There are 4 types of particle data to save to disk:
     (1) Manually Picked particles
     (2) Particles of selected 2D classes
     (3) Particles from heterogeneous refinement
     (4) Particles from homogeneous refinement (best particles)
-    """
 
-    db_loc = '../Database/'
-    entry_path = os.path.join('../Database', entry_name)
-    os.makedirs(entry_path)
-    mics_path = os.path.join(entry_path, 'Micrographs')
-    os.makedirs(mics_path)
-    particles_path = os.path.join(entry_path, 'Particles')
-    os.makedirs(particles_path)
+    If cache_dir is given, parsed .cs files are cached there (see parse_cache.py).
+    If incremental is set, a project already in the database is parsed again, and only its new jobs
+    and the jobs whose particle file changed are parsed (see manifest.py).
+    If journal is given, the outcome of each job is recorded in that CrawlJournal (see crawl_journal.py).
+    If finished_only is set, jobs still running or that failed are not parsed (see watcher.py).
+    nproc and parallel_threshold are unused, as .cs files are memory-mapped.
+    If job_index is given, the jobs are taken from it instead of reading the job.json of each job folder
+    (see csparc_job_index), eg - from the watcher, which already read them.
+    """
 
-    # Create hidden file to identify the project as data parsed from a Cryosparc project
-    with open(os.path.join(entry_path, ".csparc"), "w") as id_f:
-        pass
+    with Catalog(DB_LOC) as catalog:
+        manifest = _open_entry(dir_path, entry_name, 'csparc', catalog, incremental)
+        parsed = False
+        for particles_fp, folder in _csparc_jobs(dir_path, finished_only, job_index):
+            parsed |= _parse_job(particles_fp, folder, entry_name, catalog, manifest, cache_dir, journal)
+        if parsed or needs_dedup(os.path.join(DB_LOC, entry_name)):
+            _close_entry(entry_name, catalog)
+        elif journal is not None and journal.resumed:
+            # the crawl may have been interrupted after deduplicating the entry, before measuring its jobs again
+            catalog.update_job_bytes(entry_name)
+
+# Returns the process graph of the jobs of a Relion project (see relion_pipeline.py), read from its default_pipeline.star.
+# If the project has no readable pipeline, the jobs are listed from the job folders instead, with the inputs
+# of each job read from its job_pipeline.star.
+def _relion_pipeline(dir_path):
+    pipeline = RelionPipeline(os.path.join(dir_path, 'default_pipeline.star'))
+    if pipeline.processes:
+        return pipeline
+
+    for job_type in RELION_JOB_TYPES:
+        type_dir = os.path.join(dir_path, job_type)
+        if not os.path.isdir(type_dir):
+            continue
+        for dir_name in sorted(os.listdir(type_dir)):
+            job_dir_path = os.path.join(type_dir, dir_name)
+            # For jobs with user-given names, Relion creates a symbolink link to the real job directory
+            # Parsing only the actual job directories will prevent double-parsing particle data
+            if os.path.islink(job_dir_path) or not os.path.isdir(job_dir_path):
+                continue
+            pipeline.add_process('%s/%s/' % (job_type, dir_name))
+            pipeline.read(os.path.join(job_dir_path, 'job_pipeline.star'))
+    return pipeline
+
+# Returns the jobs of a Relion project folder to parse, as (particle file, job folder in the entry).
+# The jobs, their status and the Class2D or Class3D job each Select job selects from are found in the
+# process graph of the project, so job folders are only listed to find their particle file.
+# If finished_only is set, only the jobs that finished successfully are returned.
+# If lineage is set, only the last Refine3D job and the jobs it takes its input from, directly or through
+# other jobs, are returned (eg - only the Select jobs feeding the final 3D refinement).
+def _relion_jobs(dir_path, finished_only = False, lineage = False):
+    pipeline = _relion_pipeline(dir_path)
+    processes = [process for process in pipeline.processes if process_type(process) in RELION_JOB_TYPES]
+    if finished_only:
+        # Relion updates the status of a job in the pipeline lazily, the marker file is written as the job ends
+        processes = [process for process in processes
+                if pipeline.succeeded(process) or relion_job_finished(os.path.join(dir_path, process))]
+    if lineage:
+        refine_jobs = [process for process in processes if process_type(process) == 'Refine3D']
+        ancestors = pipeline.upstream(refine_jobs[-1]) | set(refine_jobs[-1:]) if refine_jobs else set()
+        processes = [process for process in processes if process in ancestors]
+
+    jobs = []
+    for job_type in RELION_JOB_TYPES:
+        for process in processes:
+            job_dir_path = os.path.join(dir_path, process)
+            if process_type(process) != job_type or not os.path.isdir(job_dir_path):
+                continue
+            particles_fname = _contains_particle_data(job_dir_path)
+            if not particles_fname:
+                continue
+            folder_prefix = job_type
+            if job_type == 'Select':
+                # particles of selected 2D or 3D classes
+                source = pipeline.source(process, RELION_SELECT_FOLDERS)
+                if source is not None:
+                    folder_prefix = RELION_SELECT_FOLDERS[process_type(source)]
+                else:
+                    # Inconclusive particle type. Should never happen in real use.
+                    # For debugging purposes.
+                    folder_prefix = 'Inconclusive'
+                    warnings.warn('Inconclusive particle file type of %s' % job_dir_path)
+            jobs.append((os.path.join(job_dir_path, particles_fname), '%s_%s' % (folder_prefix, os.path.basename(os.path.normpath(process)))))
 
-    # Handles manually picked particle data
-    manual_dir_path_list = [os.path.join(dir_path, dir_name) for dir_name in os.listdir(dir_path) 
-        if _csparc_job_type(os.path.join(dir_path, dir_name)) == 'manual_picker_particles']
-    for manual_job_dir in manual_dir_path_list:
-        particles_fname = _contains_particle_data_csparc(manual_job_dir)
-        if particles_fname:
-            sub_particles_path = os.path.join(particles_path, 'ManualPick_%s' % os.path.basename(os.path.normpath(manual_job_dir)))
-            os.makedirs(sub_particles_path)
-            parse_particles_project_folder(particles_fp = os.path.join(manual_job_dir, particles_fname),
-                    data_output_dir = sub_particles_path,
-                    mics_output_dir = mics_path)
-
-    # Handles particle data from selected 2D classes
-    select2D_dir_path_list = [os.path.join(dir_path, dir_name) for dir_name in os.listdir(dir_path) 
-            if _csparc_job_type(os.path.join(dir_path, dir_name)) == 'select_2D']
-    for select2D_job_dir in select2D_dir_path_list:
-        particles_fname = _contains_particle_data_csparc(select2D_job_dir)
-        if particles_fname:
-            sub_particles_path = os.path.join(particles_path, 'Select2D_%s' % os.path.basename(os.path.normpath(select2D_job_dir)))
-            os.makedirs(sub_particles_path)
-            parse_particles_project_folder(particles_fp = os.path.join(select2D_job_dir, particles_fname),
-                    data_output_dir = sub_particles_path,
-                    mics_output_dir = mics_path)
-
-    # Handles particle data from heterogenous refinement
-    hetero_dir_path_list = [os.path.join(dir_path, dir_name) for dir_name in os.listdir(dir_path)
-            if _csparc_job_type(os.path.join(dir_path, dir_name)) == 'hetero_refine']
-    for hetero_job_dir in hetero_dir_path_list:
-        particles_fname = _contains_particle_data_csparc(hetero_job_dir)
-        if particles_fname:
-            sub_particles_path = os.path.join(particles_path, 'Hetero_%s' % os.path.basename(os.path.normpath(hetero_job_dir)))
-            os.makedirs(sub_particles_path)
-            parse_particles_project_folder(particles_fp = os.path.join(hetero_job_dir, particles_fname),
-                    data_output_dir = sub_particles_path,
-                    mics_output_dir = mics_path)
-
-    # Handles particle data from homogeneous refinement
-    homo_dir_path_list = [os.path.join(dir_path, dir_name) for dir_name in os.listdir(dir_path)
-            if _csparc_job_type(os.path.join(dir_path, dir_name)) == 'homo_refine' or
-            _csparc_job_type(os.path.join(dir_path, dir_name)) == 'homo_refine_new']
-    for homo_job_dir in homo_dir_path_list:
-        particles_fname = _contains_particle_data_csparc(homo_job_dir)
-        if particles_fname:
-            sub_particles_path = os.path.join(particles_path, 'Homo_%s' % os.path.basename(os.path.normpath(homo_job_dir)))
-            os.makedirs(sub_particles_path)
-            parse_particles_project_folder(particles_fp = os.path.join(homo_job_dir, particles_fname),
-                    data_output_dir = sub_particles_path,
-                    mics_output_dir = mics_path)
+    return jobs
 
 # Parse a Relion project folder and save to disk its particle data
-def parse_relion_project(dir_path, entry_name):
+@_entry_locked
+def parse_relion_project(dir_path, entry_name, cache_dir = None, incremental = False, journal = None, finished_only = False,
+        lineage = False, nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
     """
     There are 3 types of particle data to save to disk:
     (1) Manually Picked particles
@@ -227,94 +657,28 @@ def parse_relion_project(dir_path, entry_name):
         |
         |-- ......
 
+    If cache_dir is given, parsed STAR files are cached there (see parse_cache.py).
+    If incremental is set, a project already in the database is parsed again, and only its new jobs
+    and the jobs whose particle file changed are parsed (see manifest.py).
+    If journal is given, the outcome of each job is recorded in that CrawlJournal (see crawl_journal.py).
+    If finished_only is set, jobs still running or that failed are not parsed (see watcher.py).
+    If lineage is set, only the last Refine3D job and the jobs upstream of it in the pipeline are parsed.
+    STAR files with particle tables of more than parallel_threshold bytes are each parsed with nproc processes
+    (see EMAN2star.PARALLEL_THRESHOLD), eg - a large Refine3D run_itXXX_data.star on an otherwise idle node.
     """
 
-    db_loc = '../Database/'
-    entry_path = os.path.join('../Database', entry_name)
-    os.makedirs(entry_path)
-    mics_path = os.path.join(entry_path, 'Micrographs')
-    os.makedirs(mics_path)
-    particles_path = os.path.join(entry_path, 'Particles')
-    os.makedirs(particles_path)
-
-    # Create hidden file to identify the project as data parsed from a Relion project
-    with open(os.path.join(entry_path, ".relion"), "w") as id_f:
-        pass
-
+    with Catalog(DB_LOC) as catalog:
+        manifest = _open_entry(dir_path, entry_name, 'relion', catalog, incremental)
+        parsed = False
+        for particles_fp, folder in _relion_jobs(dir_path, finished_only, lineage):
+            parsed |= _parse_job(particles_fp, folder, entry_name, catalog, manifest, cache_dir, journal,
+                    nproc = nproc, parallel_threshold = parallel_threshold)
+        if parsed or needs_dedup(os.path.join(DB_LOC, entry_name)):
+            _close_entry(entry_name, catalog)
+        elif journal is not None and journal.resumed:
+            # the crawl may have been interrupted after deduplicating the entry, before measuring its jobs again
+            catalog.update_job_bytes(entry_name)
 
-    # (1) Handles manually picked particle data
-    manual_pick_dir = os.path.join(dir_path, 'ManualPick')
-    if os.path.isdir(manual_pick_dir):
-        job_dir_path_list = [os.path.join(manual_pick_dir, dir_name) for dir_name in os.listdir(manual_pick_dir) if os.path.isdir(os.path.join(manual_pick_dir, dir_name))]
-        for job_dir_path in job_dir_path_list:
-            # For jobs with user-given names, Relion creates a symbolink link to the real job directory
-            # Parsing only the actual job directories will prevent double-parsing particle data
-            if os.path.islink(job_dir_path):
-                continue
-            if _contains_particle_data(job_dir_path):
-                sub_particles_path = os.path.join(particles_path, 'ManualPick_%s' % os.path.basename(os.path.normpath(job_dir_path)))
-                os.makedirs(sub_particles_path)
-                parse_particles_project_folder(particles_fp = os.path.join(job_dir_path, 'particles.star'), 
-                        data_output_dir = sub_particles_path,
-                        mics_output_dir = mics_path)
-
-    # (2) Handles particle data from selected 2D classes
-    # (3) Handles particle data from selected 3D classes
-    select_dir = os.path.join(dir_path, 'Select')
-    if os.path.isdir(select_dir):
-        job_dir_path_list = [os.path.join(select_dir, dir_name) for dir_name in os.listdir(select_dir) if os.path.isdir(os.path.join(select_dir, dir_name))]
-        for job_dir_path in job_dir_path_list:
-            if os.path.islink(job_dir_path):
-                continue
-            if _contains_particle_data(job_dir_path):
-                if _get_particle_type(job_dir_path) == 'Class3D':
-                    sub_particles_path = os.path.join(particles_path, 'Select3D_%s' % os.path.basename(os.path.normpath(job_dir_path)))
-                elif _get_particle_type(job_dir_path) == 'Class2D':
-                    sub_particles_path = os.path.join(particles_path, 'Select2D_%s' % os.path.basename(os.path.normpath(job_dir_path)))
-                else:
-                    # Inconclusive particle type. Should never happen in real use.
-                    # For debugging purposes.
-                    sub_particles_path = os.path.join(particles_path, 'Inconclusive_%s' % os.path.dirname(job_dir_path))
-                    warnings.warn("Inconclusive particle file type...")
-
-                os.makedirs(sub_particles_path)
-                parse_particles_project_folder(particles_fp = os.path.join(job_dir_path, 'particles.star'),
-                        data_output_dir = sub_particles_path,
-                        mics_output_dir = mics_path)
-
-    # (4) Handles cases of just one 3D reconstruction in a project - the Refine3D job
-    refine3D_dir = os.path.join(dir_path, 'Refine3D')
-    if os.path.isdir(refine3D_dir):
-        job_dir_path_list = [os.path.join(refine3D_dir, dir_name) for dir_name in os.listdir(refine3D_dir) if os.path.isdir(os.path.join(refine3D_dir, dir_name))]
-        for job_dir_path in job_dir_path_list:
-            if os.path.islink(job_dir_path):
-                continue
-            data_fname = _contains_particle_data(job_dir_path)
-            if data_fname:
-                sub_particles_path = os.path.join(particles_path, 'Refine3D_%s' % os.path.basename(os.path.normpath(job_dir_path)))
-                os.makedirs(sub_particles_path)
-                parse_particles_project_folder(particles_fp = os.path.join(job_dir_path, data_fname),
-                        data_output_dir = sub_particles_path,
-                        mics_output_dir = mics_path)
-
-
-def _get_particle_type(job_dir):
-    # Returns whether a Relion Select job deals with either
-    # 2D classes or 3D classes.
-    #
-    # Relion sub-folders have a 'job_pipeline.star' file that describes the input
-    # and output data type of a particular job. The 'data_pipeline_input_edges'
-    # section in particular describes the input job class (whether its from 
-    # 2D classification or 3D classification or something else).
-    particle_type = ""
-    with open(os.path.join(job_dir, 'job_pipeline.star'), 'r') as pipeline_f:
-        while True:
-            line = pipeline_f.readline().strip()
-            if line == "data_pipeline_input_edges":
-                particle_type = [pipeline_f.readline().strip() for i in range(5)][4]
-                break
-    particle_type  = particle_type.split('/')[0]
-    return particle_type
 
 def _automatic_job_folder_selections(db_loc):
     """
@@ -323,66 +687,42 @@ def _automatic_job_folder_selections(db_loc):
 
     For Relion projects: Refine3D_job* -> Select3D_job* -> Select2D_job*, where * is largest job number
     For CSparc projects: Homo_J* -> Hetero_J* -> Select2D_J*, where * is largest job number
+
+    Job folders are looked up in the catalog of the database (see catalog.py), by job type and number.
     """
 
     selected_job_folders = []
 
-    entries_loc = [os.path.join(db_loc, entry) for entry in os.listdir(db_loc)]
-    for entry in entries_loc:
-        if ".relion" in os.listdir(entry):
-            particles_dir = os.path.join(entry, "Particles")
-            job_folders = os.listdir(particles_dir)
-
-            refine3D_jobs = [job_name for job_name in job_folders if "Refine3D" in job_name]
-            select3D_jobs = [job_name for job_name in job_folders if "Select3D" in job_name]
-            select2D_jobs = [job_name for job_name in job_folders if "Select2D" in job_name]
-
-            if refine3D_jobs:
-                refine3D_jobs.sort()
-                refine3D_path = os.path.join(particles_dir, refine3D_jobs[-1])
-                selected_job_folders.append(refine3D_path)
-            elif select3D_jobs:
-                select3D_jobs.sort()
-                select3D_path = os.path.join(particles_dir, select3D_jobs[-1])
-                selected_job_folders.append(select3D_path)
-            elif select2D_jobs:
-                select2D_jobs.sort()
-                select2D_path = os.path.join(particles_dir, select2D_jobs[-1])
-                selected_job_folders.append(select2D_path)
-            else:
-                pass
-
-        elif ".csparc" in os.listdir(entry):
-            particles_dir = os.path.join(entry, "Particles")
-            job_folders = os.listdir(particles_dir)
-
-            homo_ref_jobs = [job_name for job_name in job_folders if "Homo" in job_name]
-            hetero_ref_jobs = [job_name for job_name in job_folders if "Hetero" in job_name]
-            select2D_jobs = [job_name for job_name in job_folders if "Select2D" in job_name]
-
-            if homo_ref_jobs:
-                homo_ref_jobs.sort()
-                homo_ref_path = os.path.join(particles_dir, homo_ref_jobs[-1])
-                selected_job_folders.append(homo_ref_path)
-            elif hetero_ref_jobs:
-                hetero_ref_jobs.sort()
-                hetero_ref_path = os.path.join(particles_dir, hetero_ref_jobs[-1])
-                selected_job_folders.append(hetero_ref_path)
-            elif select2D_jobs:
-                select2D_jobs.sort()
-                select2D_path = os.path.join(particles_dir, select2D_jobs[-1])
-                selected_job_folders.append(select2D_path)
-        else:
-            pass
+    with Catalog(db_loc) as catalog:
+        for entry in catalog.entries():
+            for job_type in SELECTION_HIERARCHY.get(entry['source'], []):
+                job = catalog.latest_job(entry['name'], job_type)
+                if job is not None:
+                    selected_job_folders.append(os.path.join(db_loc, entry['name'], 'Particles', job['folder']))
+                    break
 
     return selected_job_folders
 
 
 def main():
-    # for testing in the command-line as a script
-    # parse_particles_cryoem_projects('/net/jiang/home/zaw/scratch/Structures/EMPIAR-10117_Adenovirus/')
-    # parse_particles_cryoem_projects('/net/jiang/home/zaw/scratch/Structures/EMPIAR-10202_AAV/')
-    print(_automatic_job_folder_selections('/net/jiang/home/zaw/scratch/Online-Neural-Network/Database/'))
+    parser = argparse.ArgumentParser(description = 'Search folders for Relion and CryoSparc projects, and parse them into the database.')
+    parser.add_argument('root_dirs', nargs = '+', help = 'Folders to search for projects')
+    parser.add_argument('--workers', type = int, default = 1,
+            help = 'Number of processes parsing jobs in parallel (default: 1, parse one job at a time)')
+    parser.add_argument('--threads', type = int, default = DEFAULT_CRAWL_THREADS,
+            help = 'Number of threads listing folders when searching for projects')
+    parser.add_argument('--cache-dir', help = 'Folder caching parsed particle files (see parse_cache.py)')
+    parser.add_argument('--journal', help = 'Journal file recording the progress of the crawl, to resume it if interrupted (see crawl_journal.py)')
+    parser.add_argument('--parse-procs', type = int, default = 1,
+            help = 'Number of processes parsing each large STAR file (default: 1, parse each file in one process)')
+    parser.add_argument('--parallel-threshold', type = int, default = PARALLEL_THRESHOLD,
+            help = 'Size in bytes of the particle table of a STAR file above which it is parsed with --parse-procs processes')
+    args = parser.parse_args()
+
+    for root_dir in args.root_dirs:
+        parse_particles_cryoem_projects(root_dir, cache_dir = args.cache_dir, num_threads = args.threads,
+                num_workers = args.workers, journal_fp = args.journal, nproc = args.parse_procs,
+                parallel_threshold = args.parallel_threshold)
 
 
 if __name__ == '__main__':
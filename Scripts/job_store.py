@@ -0,0 +1,279 @@
+######
+# Binary columnar store of the particles of a job folder in the database.
+#
+# data.txt stores particles as text, which has to be split and converted to floats on every read.
+# The job store keeps the same data as NumPy arrays next to it, which are memory-mapped when loaded:
+#   particles_coords.npy: float32 (x, y) coordinates of all particles, grouped by micrograph
+#   particles_offsets.npy: int64 index, the particles of micrograph k are coords[offsets[k]:offsets[k + 1]]
+#   particles_micrographs.npy: names of the micrographs, in the same order as the offsets
+#   particles_mic_order.npy: index sorting the micrograph names, to look up a micrograph by binary search
+#   particles.json: metadata of the particles, counts and missing micrographs
+# info.txt and data.txt are still written along with the store, as an export for compatibility.
+# Jobs parsed before the store existed are converted from data.txt the first time they are opened.
+#
+# The particles of a single micrograph, or of a batch of micrographs, are read with get_particles and
+# get_particles_batch, which only page in the names searched and the coordinates returned.
+#
+# Once the jobs of an entry are deduplicated (see dedup.py), a job store can instead be a reference into
+# the shared particle table of its entry: particles.json then holds the location of the shared table and
+# its number of particles, and particles_membership.<generation>.npy a bitmap of the shared particles that
+# belong to the job. Each deduplication writes a new generation of the shared table (SharedParticles.<generation>)
+# and of the bitmaps, and only then switches the jobs to it, so a job never reads a bitmap over another table.
+######
+
+import os
+import re
+import json
+import numpy as np
+from db_commit import atomic_write_json, fsync_path
+
+STORE_VERSION = 1
+STORE_HEADER = 'particles.json'
+STORE_ARRAYS = {'coords': 'particles_coords.npy',
+                'offsets': 'particles_offsets.npy',
+                'micrographs': 'particles_micrographs.npy',
+                'order': 'particles_mic_order.npy'}
+# bitmap of the jobs deduplicated before the shared table had generations
+STORE_MEMBERSHIP = 'particles_membership.npy'
+# folder of an entry holding its shared particle table, followed by its generation
+SHARED_FOLDER = 'SharedParticles'
+
+def membership_fname(generation):
+    return 'particles_membership.%d.npy' % generation
+
+def shared_dirs(entry_path):
+    # Returns the (generation, folder) of the shared particle tables of an entry, oldest first. The table
+    # written before the shared table had generations is generation -1.
+    dirs = []
+    if os.path.isdir(entry_path):
+        for fname in os.listdir(entry_path):
+            match = re.match(r'^%s(\.(\d+))?$' % SHARED_FOLDER, fname)
+            if match:
+                dirs.append((int(match.group(2)) if match.group(2) else -1, os.path.join(entry_path, fname)))
+    return sorted(dirs)
+
+def shared_dir(entry_path):
+    # Returns the folder of the latest shared particle table of an entry, or None if it has none
+    dirs = shared_dirs(entry_path)
+    return dirs[-1][1] if dirs else None
+
+def has_job_store(job_dir):
+    return os.path.isfile(os.path.join(job_dir, STORE_HEADER))
+
+def write_job_store(job_dir, micrographs, coords, offsets, metadata, missing_mics = []):
+    """
+    Writes the job store of a job folder.
+    micrographs: names of the micrographs
+    coords: (N, 2) particle coordinates, grouped by micrograph
+    offsets: the particles of micrographs[k] are coords[offsets[k]:offsets[k + 1]]
+    metadata: dictionary with the 'voltage', 'cs', 'amp_contrast' and 'pixel_size' of the particles
+    missing_mics: names of the micrographs that could not be found
+    """
+    offsets = np.asarray(offsets, dtype = np.int64)
+    assert(len(offsets) == len(micrographs) + 1 and offsets[-1] == len(coords)) # sanity check
+
+    np.save(os.path.join(job_dir, STORE_ARRAYS['coords']), np.asarray(coords, dtype = np.float32).reshape(-1, 2))
+    np.save(os.path.join(job_dir, STORE_ARRAYS['offsets']), offsets)
+    micrographs = np.array(micrographs, dtype = str).reshape(-1)
+    np.save(os.path.join(job_dir, STORE_ARRAYS['micrographs']), micrographs)
+    np.save(os.path.join(job_dir, STORE_ARRAYS['order']), np.argsort(micrographs, kind = 'stable'))
+
+    # the header is written last, so a job only has a store once all of its arrays are on disk
+    header = {'version': STORE_VERSION,
+              'num_particles': int(offsets[-1]),
+              'num_mics': len(micrographs),
+              'metadata': dict((key, float(value)) for key, value in metadata.items()),
+              'missing_mics': list(missing_mics)}
+    atomic_write_json(os.path.join(job_dir, STORE_HEADER), header, indent = 1)
+
+def write_job_membership(job_dir, membership, generation):
+    """
+    Writes the bitmap of a job over a generation of the shared particle table, next to the bitmap the job
+    uses now. The job only uses it once switched to the generation by write_job_reference.
+    membership: boolean mask of the shared particles that belong to the job
+    """
+    fp = os.path.join(job_dir, membership_fname(generation))
+    np.save(fp, np.packbits(np.asarray(membership, dtype = bool)))
+    fsync_path(fp)
+
+def write_job_reference(job_dir, shared_dir, membership, metadata, missing_mics = [], generation = 0):
+    """
+    Writes the job store of a job folder as a reference into a shared particle table, whose bitmap was
+    written by write_job_membership.
+    shared_dir: folder of the job store holding the shared particle table, of the given generation
+    membership: boolean mask of the shared particles that belong to the job
+    """
+    membership = np.asarray(membership, dtype = bool)
+    header = {'version': STORE_VERSION,
+              'shared': os.path.relpath(shared_dir, job_dir),
+              'shared_rows': len(membership),
+              'membership': membership_fname(generation),
+              'num_particles': int(np.count_nonzero(membership)),
+              'metadata': dict((key, float(value)) for key, value in metadata.items()),
+              'missing_mics': list(missing_mics)}
+    atomic_write_json(os.path.join(job_dir, STORE_HEADER), header, indent = 1)
+
+    # the particles are now only stored in the shared table, and the bitmaps over other tables are not used
+    for fname in os.listdir(job_dir):
+        if fname in STORE_ARRAYS.values() or (fname.startswith('particles_membership') and fname != header['membership']):
+            os.remove(os.path.join(job_dir, fname))
+
+def read_data_txt(job_dir):
+    # Parses the info.txt and data.txt of a job folder written before the job store existed.
+    # Returns the arguments of write_job_store as a tuple.
+    with open(os.path.join(job_dir, 'data.txt')) as data_f:
+        sections = data_f.read().split('$')[:-1]
+
+    # the first section holds the particle metadata
+    metadata = {}
+    keys = {'Voltage': 'voltage', 'CS': 'cs', 'AmpContrast': 'amp_contrast', 'PixelSize': 'pixel_size'}
+    for line in filter(None, sections[0].split('\n')):
+        key, value = line.split()
+        metadata[keys[key]] = float(value)
+
+    micrographs = []
+    coords = []
+    for mic_data in sections[1:]:
+        lines = list(filter(None, mic_data.split('\n')))
+        micrographs.append(lines[0].split()[-1])
+        coords.append(np.array([line.split() for line in lines[1:]], dtype = np.float64).reshape(-1, 2))
+    offsets = np.concatenate(([0], np.cumsum([len(mic_coords) for mic_coords in coords])))
+    coords = np.concatenate(coords) if coords else np.empty((0, 2))
+
+    missing_mics = []
+    info_fp = os.path.join(job_dir, 'info.txt')
+    if os.path.isfile(info_fp):
+        with open(info_fp) as info_f:
+            info = info_f.read().split('$')
+        if len(info) > 1:
+            missing_mics = list(filter(None, info[1].split('\n')))[1:]
+
+    return micrographs, coords, offsets, metadata, missing_mics
+
+class JobStore(object):
+    """
+    Particles of a job folder, loaded from its job store. The arrays are memory-mapped, so opening
+    a job does not read its particles, and only the micrographs accessed are paged in from disk.
+    """
+
+    def __init__(self, job_dir, mmap = True):
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, STORE_HEADER)) as header_f:
+            header = json.load(header_f)
+        if header.get('version', 0) > STORE_VERSION:
+            raise Exception('Job store of %s was written by a newer version (%d).' % (job_dir, header['version']))
+        self.metadata = header['metadata']
+        self.missing_mics = header['missing_mics']
+
+        mmap_mode = 'r' if mmap else None
+        # rows of the coordinates holding the particles of the job, or None if the job stores its own particles
+        self.rows = None
+        if 'shared' in header:
+            self._load_reference(os.path.join(job_dir, header['shared']), header, mmap)
+            return
+
+        self.coords = np.load(os.path.join(job_dir, STORE_ARRAYS['coords']), mmap_mode = mmap_mode)
+        self.offsets = np.load(os.path.join(job_dir, STORE_ARRAYS['offsets']), mmap_mode = mmap_mode)
+        self.micrographs = np.load(os.path.join(job_dir, STORE_ARRAYS['micrographs']), mmap_mode = mmap_mode)
+        order_fp = os.path.join(job_dir, STORE_ARRAYS['order'])
+        if os.path.isfile(order_fp):
+            self.order = np.load(order_fp, mmap_mode = mmap_mode)
+        else:
+            # stores written before the index existed
+            self.order = np.argsort(self.micrographs, kind = 'stable')
+
+    def _load_reference(self, shared_dir, header, mmap):
+        # Loads a job stored as a membership bitmap of a shared particle table
+        shared = JobStore(shared_dir, mmap = mmap)
+        bits = np.load(os.path.join(self.job_dir, header.get('membership', STORE_MEMBERSHIP)))
+        # a bitmap over another table would silently select the wrong particles
+        if header.get('shared_rows', len(shared)) != len(shared) or len(bits) != (len(shared) + 7) // 8:
+            raise Exception('The particles of %s are a bitmap over %s particles, but its shared table %s has %d.'
+                    % (self.job_dir, header.get('shared_rows', 8 * len(bits)), shared_dir, len(shared)))
+        self.rows = np.flatnonzero(np.unpackbits(bits, count = len(shared)))
+        # number of particles of the job on each micrograph of the shared table
+        counts = np.diff(np.searchsorted(self.rows, shared.offsets))
+        present = np.flatnonzero(counts)
+        self.coords = shared.coords
+        self.micrographs = shared.micrographs[present]
+        self.offsets = np.concatenate(([0], np.cumsum(counts[present])))
+        self.order = np.argsort(self.micrographs, kind = 'stable')
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def num_micrographs(self):
+        return len(self.micrographs)
+
+    def micrograph_indices(self, mic_names):
+        # Returns the positions of micrographs in the store, with -1 for the micrographs the job does not have.
+        # Micrographs can be given by name or by path.
+        mic_names = np.array([os.path.basename(mic) for mic in mic_names], dtype = str)
+        if len(self.micrographs) == 0:
+            return np.full(len(mic_names), -1, dtype = np.int64)
+        pos = np.searchsorted(self.micrographs, mic_names, sorter = self.order)
+        indices = np.asarray(self.order[np.minimum(pos, len(self.order) - 1)], dtype = np.int64)
+        indices[self.micrographs[indices] != mic_names] = -1
+        return indices
+
+    def micrograph_index(self, mic_name):
+        # Returns the position of a micrograph in the store, or None if the job has no such micrograph
+        k = self.micrograph_indices([mic_name])[0]
+        return None if k < 0 else int(k)
+
+    def particles(self, mic_name):
+        # Returns the (x, y) coordinates of the particles on a micrograph, or raises KeyError if the job does not have it
+        k = self.micrograph_index(mic_name)
+        if k is None:
+            raise KeyError(mic_name)
+        return self.micrograph_particles(k)
+
+    def particles_batch(self, mic_names):
+        # Returns a dictionary of micrograph -> (x, y) coordinates of its particles, for the micrographs
+        # of the job among mic_names. All micrographs are looked up at once, in the order they are stored.
+        mic_names = list(mic_names)
+        indices = self.micrograph_indices(mic_names)
+        found = np.flatnonzero(indices >= 0)
+        found = found[np.argsort(indices[found], kind = 'stable')]
+        return dict((mic_names[i], self.micrograph_particles(indices[i])) for i in found)
+
+    def micrograph_particles(self, k):
+        # Returns the (x, y) coordinates of the particles on the k-th micrograph
+        if self.rows is not None:
+            return self.coords[self.rows[self.offsets[k]:self.offsets[k + 1]]]
+        return self.coords[self.offsets[k]:self.offsets[k + 1]]
+
+    def particle_coords(self, indices = slice(None)):
+        # Returns the (x, y) coordinates of particles of the job, by their position in the job (grouped by micrograph)
+        if self.rows is not None:
+            return self.coords[self.rows[indices]]
+        return self.coords[indices]
+
+    def __iter__(self):
+        # Yields (micrograph name, particle coordinates) for every micrograph of the job
+        for k in range(len(self.micrographs)):
+            yield str(self.micrographs[k]), self.micrograph_particles(k)
+
+def open_job_store(job_dir, mmap = True):
+    """
+    Returns the JobStore of a job folder. Jobs with only data.txt are converted to a job store
+    first, so the text is parsed at most once.
+    """
+    if not has_job_store(job_dir):
+        write_job_store(job_dir, *read_data_txt(job_dir))
+    return JobStore(job_dir, mmap = mmap)
+
+def get_particles(job_dir, micrograph):
+    """
+    Returns the (x, y) coordinates of the particles of a job on one micrograph, given by name or path.
+    Raises KeyError if the job has no particles on the micrograph.
+    """
+    return open_job_store(job_dir).particles(micrograph)
+
+def get_particles_batch(job_dir, micrographs):
+    """
+    Returns a dictionary of micrograph -> (x, y) coordinates of the particles of a job, for each of the
+    given micrographs that the job has particles on. The job store is opened once for the whole batch.
+    """
+    return open_job_store(job_dir).particles_batch(micrographs)
@@ -0,0 +1,46 @@
+######
+# Manifest of the job folders parsed into a database entry.
+#
+# For each job folder of an entry, the manifest records the particle file it was parsed from, with the
+# size and modification time of the file when it was parsed. When a project already in the database is
+# parsed again (see the incremental mode of file_crawler.py), jobs whose particle file is unchanged are
+# skipped, and only new or changed jobs are parsed. The manifest is stored as manifest.json in the entry.
+######
+
+import os
+import json
+from db_commit import atomic_write_json
+
+MANIFEST_NAME = 'manifest.json'
+
+def source_state(particles_fp):
+    # Returns what identifies the state of a particle file: its path, size and modification time
+    stat = os.stat(particles_fp)
+    return {'source': os.path.abspath(particles_fp), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+class Manifest(object):
+    """
+    Manifest of an entry folder, as a dictionary of job folder -> state of its particle file.
+    A missing or unreadable manifest is empty, so every job of the entry is parsed again.
+    """
+
+    def __init__(self, entry_path):
+        self.path = os.path.join(entry_path, MANIFEST_NAME)
+        try:
+            with open(self.path) as manifest_f:
+                self.jobs = json.load(manifest_f)
+        except (IOError, ValueError):
+            self.jobs = {}
+
+    def is_current(self, folder, particles_fp):
+        # Returns whether a job folder was parsed from the particle file as it is now
+        return self.jobs.get(folder) == source_state(particles_fp)
+
+    def update(self, folder, particles_fp):
+        # Records that a job folder was parsed from the particle file as it is now
+        self.jobs[folder] = source_state(particles_fp)
+        self.save()
+
+    def save(self):
+        # written under a temporary name then renamed, so an interrupted parse never leaves a partial manifest
+        atomic_write_json(self.path, self.jobs, indent = 1, sort_keys = True)
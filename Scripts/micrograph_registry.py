@@ -0,0 +1,202 @@
+######
+# Registry of the source micrographs linked into the database.
+#
+# Each micrograph file a particle file refers to is registered under a content key made of its size,
+# modification time and a hash of a few sampled blocks of the file, so the same micrograph is recognized
+# across jobs and entries, and when it is moved to another folder. Size and modification time alone are
+# not enough to tell micrographs apart (eg - files of the same size extracted from an archive in the same
+# second), so a missing micrograph is only taken to have moved to a file of the same name with the same
+# hashed content key. The registry is kept in
+# the catalog of the database (see catalog.py):
+#   sources: absolute path of each micrograph file, its folder, content key and size, whether it is
+#            missing and, for a missing file whose content was found at another path, where it moved to
+#   source_dirs: modification time of each source folder when it was last listed
+#
+# Instead of checking every micrograph path with its own stat, the micrographs asked for are grouped by
+# folder and each folder is listed once. A folder unchanged since it was last listed is not stat-ed
+# further, as its files are already registered. Micrographs of a folder are resolved once per registry,
+# however many jobs refer to them.
+#
+# Processes that only read the catalog (eg - the workers of a parallel crawl, see file_crawler.py) use a
+# deferred registry: its writes are kept as records, and applied to the catalog by the process writing it.
+######
+
+import os
+import sqlite3
+import hashlib
+from collections import defaultdict
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    key TEXT,
+    bytes INTEGER,
+    missing INTEGER NOT NULL DEFAULT 0,
+    moved_to TEXT
+);
+CREATE INDEX IF NOT EXISTS sources_by_dir ON sources (dir);
+CREATE INDEX IF NOT EXISTS sources_by_key ON sources (key);
+CREATE TABLE IF NOT EXISTS source_dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+"""
+
+# number of blocks of a file hashed by sampled_hash, and their size in bytes
+NUM_SAMPLES = 3
+DEFAULT_SAMPLE_BYTES = 4096
+
+def sampled_hash(path, size, sample_bytes):
+    # Returns a hash of sample_bytes read at the start, middle and end of a file
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for k in range(NUM_SAMPLES):
+            f.seek(max(0, (size - sample_bytes) * k // (NUM_SAMPLES - 1)))
+            digest.update(f.read(sample_bytes))
+    return digest.hexdigest()
+
+def content_key(path, st, sample_bytes = 0):
+    # Returns the content key of a file from its stat, with a sampled hash if sample_bytes is set
+    key = '%d-%d' % (st.st_size, st.st_mtime_ns)
+    if sample_bytes:
+        key += '-' + sampled_hash(path, st.st_size, sample_bytes)
+    return key
+
+def _can_be_moved(key, path, other_path):
+    # Returns whether a micrograph can have moved from path to other_path, both registered with the content key
+    # key: only if the key has a hash of the contents of the files, and the files have the same name
+    return key is not None and key.count('-') == 2 and os.path.basename(path) == os.path.basename(other_path)
+
+class MicrographRegistry(object):
+    """
+    Registry of source micrographs, stored in an SQLite connection (in memory if conn is not given).
+    sample_bytes: size of the blocks sampled from each file for the hash in its content key. If 0, content
+    keys have no hash, and missing micrographs are never taken to have moved.
+    deferred: if set, the registry is only read from conn, and its writes are kept in records instead, to be
+    applied to the registry of the catalog with apply()
+    """
+
+    def __init__(self, conn = None, sample_bytes = DEFAULT_SAMPLE_BYTES, deferred = False):
+        self.conn = sqlite3.connect(':memory:') if conn is None else conn
+        self.sample_bytes = sample_bytes
+        self.deferred = deferred
+        self.records = []
+        if not deferred:
+            with self.conn:
+                self.conn.executescript(REGISTRY_SCHEMA)
+        # names of the files of each source folder listed, and whether the folder changed since it was last listed
+        self._listings = {}
+        # (path, size in bytes) of each micrograph resolved, or None if it is missing
+        self._resolved = {}
+
+    def _list_dir(self, dir_path):
+        # Lists a source folder once, returning the names of the files in it and whether it changed
+        if dir_path not in self._listings:
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+                names = set(entry.name for entry in os.scandir(dir_path) if entry.is_file())
+            except OSError:
+                mtime_ns, names = None, set()
+            row = self.conn.execute('SELECT mtime_ns FROM source_dirs WHERE path = ?', (dir_path,)).fetchone()
+            changed = row is None or mtime_ns is None or row[0] != mtime_ns
+            if changed and mtime_ns is not None:
+                self._write(('dir', dir_path, mtime_ns))
+            self._listings[dir_path] = (names, changed)
+        return self._listings[dir_path]
+
+    def _exists(self, path):
+        # Returns whether a file exists, from the listing of its folder
+        return os.path.basename(path) in self._list_dir(os.path.dirname(path))[0]
+
+    def resolve(self, paths):
+        """
+        Resolves the paths of micrographs to the files to link them from.
+        Returns a list with, for each path, the (path, size in bytes) of the micrograph, which is another
+        path if the file was moved there, or None if the micrograph cannot be found.
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        by_dir = defaultdict(list)
+        for path in paths:
+            if path not in self._resolved:
+                by_dir[os.path.dirname(path)].append(path)
+
+        for dir_path, dir_paths in by_dir.items():
+            names, changed = self._list_dir(dir_path)
+            rows = dict((row[0], row) for row in self.conn.execute(
+                    'SELECT path, key, bytes, missing FROM sources WHERE dir = ?', (dir_path,)))
+            found = []
+            missing = []
+            for path in dir_paths:
+                row = rows.get(path)
+                if os.path.basename(path) not in names:
+                    missing.append(path)
+                elif row is not None and row[1] is not None and not row[3] and not changed:
+                    # registered, and its folder has not changed since
+                    self._resolved[path] = (path, row[2])
+                else:
+                    try:
+                        st = os.stat(path)
+                        found.append((path, dir_path, content_key(path, st, self.sample_bytes), st.st_size))
+                        self._resolved[path] = (path, st.st_size)
+                    except OSError:
+                        missing.append(path)
+
+            if found:
+                self._write(('found', found))
+            for path in missing:
+                self._resolved[path] = self._resolve_missing(path, dir_path)
+
+        return [self._resolved[path] for path in paths]
+
+    def _resolve_missing(self, path, dir_path):
+        # Records a micrograph as missing, and returns where its content is found now, if it is registered elsewhere
+        row = self.conn.execute('SELECT key FROM sources WHERE path = ?', (path,)).fetchone()
+        key = row[0] if row is not None else None
+        moved_to = None
+        if key is not None:
+            for other_path, size in self.conn.execute("""SELECT path, bytes FROM sources
+                    WHERE key = ? AND missing = 0 AND path != ?""", (key, path)).fetchall():
+                if _can_be_moved(key, path, other_path) and self._exists(other_path):
+                    moved_to = (other_path, size)
+                    break
+        self._write(('missing', path, dir_path, key, moved_to[0] if moved_to else None))
+        return moved_to
+
+    def _write(self, record):
+        # Writes a record to the registry, or keeps it for apply() if the registry is deferred
+        if self.deferred:
+            self.records.append(record)
+        else:
+            self.apply([record])
+
+    def apply(self, records):
+        """
+        Writes records to the registry (eg - the records of a deferred registry):
+        ('dir', folder, modification time): a source folder was listed
+        ('found', [(path, folder, content key, size in bytes)]): micrographs were found
+        ('missing', path, folder, content key, path it moved to): a micrograph is missing
+        """
+        with self.conn:
+            for record in records:
+                if record[0] == 'dir':
+                    self.conn.execute('INSERT OR REPLACE INTO source_dirs VALUES (?, ?)', record[1:])
+                elif record[0] == 'found':
+                    self.conn.executemany('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, 0, NULL)', record[1])
+                    # missing files with the same name and content were moved to the files found
+                    for path, _, key, _ in record[1]:
+                        for (old_path,) in self.conn.execute("""SELECT path FROM sources
+                                WHERE key = ? AND missing = 1 AND path != ?""", (key, path)).fetchall():
+                            if _can_be_moved(key, old_path, path):
+                                self.conn.execute('UPDATE sources SET moved_to = ? WHERE path = ?', (path, old_path))
+                else:
+                    self.conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, NULL, 1, ?)', record[1:])
+
+    def missing(self):
+        # Returns the micrographs registered as missing, with where they moved to if known
+        return self.conn.execute('SELECT * FROM sources WHERE missing = 1 ORDER BY path').fetchall()
+
+    def moved(self):
+        # Returns the micrographs that were moved, as (old path, new path)
+        return self.conn.execute("""SELECT path, moved_to FROM sources
+                WHERE missing = 1 AND moved_to IS NOT NULL ORDER BY path""").fetchall()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+######
+# Sidecar cache for the results of parse_relion and parse_csparc.
+#
+# The dictionary returned by a parser is stored as a .npz file in a cache directory, keyed by the
+# absolute path, size and modification time of the parsed file (and optionally a hash of its contents),
+# along with the parser name and arguments, and the path, size and modification time of the other files
+# the parser reads, if any. Unchanged files are then loaded from the cache in
+# milliseconds instead of being parsed again on every crawl.
+#
+# The cache is capped in size: when it grows past max_bytes, the least recently used entries are
+# removed. Entries can also be removed explicitly, for one file or for the whole cache:
+#   $parse_cache.py invalidate Refine3D/job035/run_it025_data.star
+#   $parse_cache.py invalidate --all
+######
+
+import os
+import json
+import glob
+import hashlib
+import argparse
+import numpy as np
+from EMAN2star import EncodedColumn
+
+DEFAULT_CACHE_DIR = '../Cache/'
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+def _path_key(fp):
+    # All cache entries of a file start with the hash of its absolute path
+    return hashlib.sha1(os.path.abspath(fp).encode()).hexdigest()[:16]
+
+def _content_hash(fp):
+    sha = hashlib.sha1()
+    with open(fp, 'rb') as f:
+        while True:
+            buf = f.read(1 << 20)
+            if not buf:
+                break
+            sha.update(buf)
+    return sha.hexdigest()
+
+def cache_path(fp, cache_dir, parser_name = '', args = {}, hash_content = False, depends = ()):
+    """
+    Returns the location of the cache entry for a parsed file. The entry name changes whenever the
+    path, size or modification time of the file changes, or its contents if hash_content is set.
+    depends: other files read by the parser, whose path, size and modification time are also part of the entry name
+    """
+    stat = os.stat(fp)
+    identity = [os.path.abspath(fp), stat.st_size, stat.st_mtime_ns, parser_name, sorted(args.items())]
+    for depend_fp in depends:
+        depend_stat = os.stat(depend_fp)
+        identity.append((os.path.abspath(depend_fp), depend_stat.st_size, depend_stat.st_mtime_ns))
+    if hash_content:
+        identity.append(_content_hash(fp))
+    identity_key = hashlib.sha1(repr(identity).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s-%s.npz' % (_path_key(fp), identity_key))
+
+def _flatten(data_dict, path, arrays, manifest):
+    for key, value in data_dict.items():
+        if isinstance(value, dict):
+            _flatten(value, path + [key], arrays, manifest)
+        elif isinstance(value, EncodedColumn):
+            names = ['a%d' % len(arrays), 'a%d' % (len(arrays) + 1)]
+            arrays[names[0]] = value.categories
+            arrays[names[1]] = value.codes
+            manifest.append([path + [key], 'encoded', names])
+        else:
+            name = 'a%d' % len(arrays)
+            arrays[name] = np.asarray(value)
+            manifest.append([path + [key], 'array', [name]])
+
+def save_cached(data_dict, cache_file, max_bytes = DEFAULT_MAX_BYTES):
+    # Writes a parsed dictionary to the cache. Nested dictionaries, NumPy arrays and scalars, and
+    # EncodedColumns are supported. The file is written under a temporary name then renamed, so
+    # other processes never load a partially written entry.
+    cache_dir = os.path.dirname(cache_file)
+    os.makedirs(cache_dir, exist_ok = True)
+
+    arrays = {}
+    manifest = []
+    _flatten(data_dict, [], arrays, manifest)
+    arrays['manifest'] = np.array(json.dumps(manifest))
+
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, cache_file)
+
+    evict(cache_dir, max_bytes)
+
+def load_cached(cache_file):
+    # Returns the dictionary stored in a cache entry, or None if there is no such entry
+    try:
+        npz = np.load(cache_file)
+    except (IOError, ValueError):
+        return None
+
+    data_dict = {}
+    with npz:
+        for path, kind, names in json.loads(str(npz['manifest'])):
+            target = data_dict
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            if kind == 'encoded':
+                target[path[-1]] = EncodedColumn(npz[names[0]], npz[names[1]])
+            else:
+                value = npz[names[0]]
+                target[path[-1]] = value[()] if value.ndim == 0 else value
+
+    # mark the entry as recently used for LRU eviction
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return data_dict
+
+def cached_parse(parser, fp, cache_dir = None, hash_content = False, max_bytes = DEFAULT_MAX_BYTES, depends = (), options = {}, **kwargs):
+    """
+    Returns parser(fp, **kwargs), loading it from the cache in cache_dir if the file (and the files in
+    depends) has not changed since it was last parsed. If cache_dir is None, caching is disabled and
+    the file is always parsed.
+    options: other arguments of the parser that do not change its result (eg - the number of processes
+    parsing the file), passed to the parser but not part of the cache key
+    """
+    if cache_dir is None:
+        return parser(fp, **kwargs, **options)
+
+    cache_file = cache_path(fp, cache_dir, parser.__name__, kwargs, hash_content, depends)
+    data_dict = load_cached(cache_file)
+    if data_dict is None:
+        data_dict = parser(fp, **kwargs, **options)
+        save_cached(data_dict, cache_file, max_bytes)
+    return data_dict
+
+def evict(cache_dir, max_bytes = DEFAULT_MAX_BYTES):
+    # Removes the least recently used entries until the cache is no larger than max_bytes
+    entries = []
+    for cache_file in glob.glob(os.path.join(cache_dir, '*.npz')):
+        try:
+            stat = os.stat(cache_file)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_file))
+
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, cache_file in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+        total -= size
+
+def invalidate(cache_dir, fp = None):
+    # Removes the cache entries of a parsed file, or the whole cache if no file is given
+    pattern = '*.npz' if fp is None else '%s-*.npz' % _path_key(fp)
+    for cache_file in glob.glob(os.path.join(cache_dir, pattern)):
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Manage the cache of parsed particle files.')
+    parser.add_argument('task', help = "Either 'invalidate' or 'prune'")
+    parser.add_argument('files', nargs = '*', help = 'Particle files whose cache entries are removed')
+    parser.add_argument('--all', action = 'store_true', help = 'Remove every entry in the cache')
+    parser.add_argument('--cache-dir', default = DEFAULT_CACHE_DIR, help = 'Location of the cache')
+    parser.add_argument('--max-bytes', type = int, default = DEFAULT_MAX_BYTES, help = 'Size cap used when pruning')
+    args = parser.parse_args()
+
+    if args.task == 'invalidate':
+        if args.all:
+            invalidate(args.cache_dir)
+        elif args.files:
+            for fp in args.files:
+                invalidate(args.cache_dir, fp)
+        else:
+            raise Exception("Provide the particle files to invalidate, or --all to clear the cache.")
+    elif args.task == 'prune':
+        evict(args.cache_dir, args.max_bytes)
+    else:
+        raise Exception("Invalid task: choose to either 'invalidate' entries or 'prune' the cache.")
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,132 @@
+import os
+import re
+import glob
 import numpy as np
 import warnings
+from parse_cache import cached_parse
+from particle_table import ParticleTable, register_reader
 
-def parse_csparc(fp):
+######
+# .cs files are loaded with memory mapping, and only the fields used for training data are copied
+# out of them, so the unused fields (alignments, blob paths, ...) are never read into memory.
+#
+# Some jobs only write a subset of the fields in their particle file, and keep the rest in sibling
+# files of the same output group in the same job folder (eg - J5_particles_selected.cs and
+# J5_passthrough_particles_selected.cs). Fields missing from the particle file are taken from these
+# files, passthrough or not, and matched to the particles by their 'uid'.
+######
+
+def _load_cs(fp):
     try:
-        cs = np.load(fp)
+        return np.load(fp, mmap_mode='r')
     except:
         raise Exception("ERROR: cannot parse file")
 
+def _match_uids(uids, other_uids):
+    # Returns the rows of other_uids holding each of the uids, or None if some are missing
+    if len(uids) == len(other_uids) and np.array_equal(uids, other_uids):
+        return slice(None)
+    if len(other_uids) == 0:
+        return None
+    order = np.argsort(other_uids)
+    rows = order[np.clip(np.searchsorted(other_uids, uids, sorter=order), 0, len(other_uids) - 1)]
+    if not np.array_equal(other_uids[rows], uids):
+        return None
+    return rows
+
+def _output_group(fp):
+    # Returns the output group of a .cs file, eg - 'particles_selected' for J5_passthrough_particles_selected.cs
+    match = re.search(r'(particles\w*)\.cs$', os.path.basename(fp))
+    return match.group(1) if match else None
+
+def sibling_files(fp):
+    # Returns the other .cs files of the output group of fp in its folder: the passthrough files first,
+    # then the others from the latest iteration to the first
+    group = _output_group(fp)
+    if group is None:
+        return []
+    siblings = sorted([f for f in glob.glob(os.path.join(os.path.dirname(os.path.abspath(fp)), '*.cs'))
+                       if _output_group(f) == group and not os.path.samefile(f, fp)], reverse=True)
+    return sorted(siblings, key=lambda f: 'passthrough' not in os.path.basename(f))
+
+def parse_csparc(fp, passthrough=None):
+    # passthrough: list of .cs files holding fields missing from fp. By default, the sibling files of
+    # the same output group as fp are used (see sibling_files).
+    cs = _load_cs(fp)
+    if passthrough is None:
+        passthrough = sibling_files(fp)
+
+    # sources of fields: (memory-mapped array, rows matching the particles of fp)
+    sources = [(cs, slice(None))]
+    passthrough_loaded = False
+    def field_source(field):
+        nonlocal passthrough_loaded
+        if not passthrough_loaded and field not in cs.dtype.names:
+            # passthrough files are only opened the first time a field is missing
+            passthrough_loaded = True
+            uids = np.array(cs['uid']) if 'uid' in cs.dtype.names else None
+            for pt_fp in passthrough:
+                pt = _load_cs(pt_fp)
+                rows = None
+                if uids is not None and 'uid' in pt.dtype.names:
+                    rows = _match_uids(uids, np.array(pt['uid']))
+                if rows is None:
+                    warnings.warn("CS file %s does not hold all particles of %s" % (pt_fp, fp))
+                else:
+                    sources.append((pt, rows))
+        for source in sources:
+            if field in source[0].dtype.names:
+                return source
+        return None
+
+    def copy_field(source, field):
+        # copy the field out of the memory-mapped array, then select the matching rows
+        return np.array(source[0][field])[source[1]]
+
+    def first_value(source, field):
+        rows = source[1]
+        return source[0][field][0 if isinstance(rows, slice) else rows[0]]
+
     cs_dict = {}
 
     # Parse the necessary metadata
     metadata_list = ['ctf/accel_kv', 'ctf/cs_mm', 'ctf/amp_contrast', 'blob/psize_A']
     for metadata in metadata_list:
-        if metadata not in cs.dtype.names:
+        source = field_source(metadata)
+        if source is None:
             warnings.warn("CS file is missing metadata: %s" % metadata)
         else:
-            cs_dict[metadata] = cs[metadata][0]
+            cs_dict[metadata] = first_value(source, metadata)
 
     # Parse the particle locations (x, y) and micrographs, and micrograph shape
     parameter_list = ['location/center_x_frac', 'location/center_y_frac', 'location/micrograph_path', 'location/micrograph_shape']
-    assert(len(cs['location/center_x_frac']) == len(cs['location/center_y_frac']) == len(cs['location/micrograph_path'])) # sanity check
     for parameter in parameter_list:
-        if parameter not in cs.dtype.names:
+        source = field_source(parameter)
+        if source is None:
             raise Exception("CS file is missing necessary parameter: %s" % parameter)
-        cs_dict[parameter] = cs[parameter]
+        cs_dict[parameter] = copy_field(source, parameter)
+    assert(len(cs_dict['location/center_x_frac']) == len(cs_dict['location/center_y_frac']) == len(cs_dict['location/micrograph_path'])) # sanity check
 
     return cs_dict
 
+@register_reader('.cs')
+def read_csparc_particles(fp, cache_dir = None, stream = False, nproc = 1, parallel_threshold = None):
+    # Reads a CS file into a ParticleTable, converting the fractional particle locations to pixel
+    # coordinates for all particles at once. Micrograph paths are decoded once per micrograph.
+    # stream, nproc, parallel_threshold: unused, since .cs files are already memory-mapped
+    # cache_dir: if given, the parsed file is cached there (see parse_cache.py)
+    # the fields taken from the sibling files are cached too, so the entry changes when they do
+    data_dict = cached_parse(parse_csparc, fp, cache_dir, depends = sibling_files(fp))
 
-    
+    # By default, assume that the CryoSparc project folder is one directory above the job folder of the CS file
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(fp)))
 
-    
+    paths, mic_codes = np.unique(data_dict['location/micrograph_path'], return_inverse = True)
+    micrographs = np.array([path.decode('utf-8') for path in paths])
+    shape = data_dict['location/micrograph_shape']
+    x_coords = data_dict['location/center_x_frac'] * shape[:, 0]
+    y_coords = data_dict['location/center_y_frac'] * shape[:, 1]
+
+    metadata_list = ['ctf/accel_kv', 'ctf/cs_mm', 'ctf/amp_contrast', 'blob/psize_A']
+    metadata = dict((key, data_dict[m]) for key, m in zip(ParticleTable.metadata_keys, metadata_list) if m in data_dict)
+    return ParticleTable(micrographs, mic_codes, x_coords, y_coords, metadata = metadata, project_dir = project_dir)
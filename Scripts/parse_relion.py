@@ -11,26 +11,53 @@
 # to save training data to a centralized database.
 ######
 
-from EMAN2star import StarFile
+import os
+from EMAN2star import StarFile, PARALLEL_THRESHOLD
+from parse_cache import cached_parse
+from particle_table import ParticleTable, register_reader
+from array import array
+import numpy as np
 import warnings
 
-def parse_relion(fp):
- 
-    star_dict = StarFile(fp)
+def parse_relion(fp, columns = [], nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    # columns: extra loop columns to return along with the particle coordinates, micrographs and metadata.
+    # Only these columns are converted when parsing; the rest of each row (eg - rlnImageName) is skipped.
+    # nproc: number of processes used to parse particle tables of more than parallel_threshold bytes
+
+    metadata_list = ['rlnVoltage', 'rlnSphericalAberration', 'rlnAmplitudeContrast', 'rlnImagePixelSize']
+    parameter_list = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnMicrographName']
+
+    # Loop values are read as typed NumPy columns, with micrograph names dictionary-encoded
+    star_dict = StarFile(fp, streaming = True, columnar = True,
+            columns = metadata_list + parameter_list + ['rlnOpticsGroup'] + list(columns), nproc = nproc,
+            parallel_threshold = parallel_threshold)
+    index = star_dict.getindex()
+    if 'particles' in index:
+        # Relion 3.1 and later: the metadata is stored per optics group in data_optics,
+        # and the particles in data_particles. Seek straight to each block.
+        star_dict.readfile('particles')
+        optics_dict = star_dict.readblock('optics') if 'optics' in index else {}
+    else:
+        # Relion 3.0: a single block, with the metadata repeated on every particle row
+        star_dict.readfile()
+        optics_dict = star_dict
 
     training_data_dict = {}
 
     # Check that the STAR file contains necessary metadata for the particles
-    metadata_list = ['rlnVoltage', 'rlnSphericalAberration', 'rlnAmplitudeContrast', 'rlnImagePixelSize']
+    optics = join_optics(star_dict, optics_dict, metadata_list)
     for metadata in metadata_list:
-        if metadata not in star_dict:
+        if metadata not in optics:
             warnings.warn('STAR file is missing metadata: %s' % metadata)
-        else:
-            training_data_dict[metadata] =  star_dict[metadata][0]
+        elif len(optics[metadata]) > 0:
+            if len(np.unique(optics[metadata])) > 1:
+                warnings.warn('STAR file has more than one value of %s: using the value of the first particle' % metadata)
+            training_data_dict[metadata] = optics[metadata][0]
+    # per-particle metadata values
+    training_data_dict['optics'] = optics
 
 
     # Check that the STAR file has the following necessary parameters for particles
-    parameter_list = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnMicrographName']
     for parameter in parameter_list:
         if parameter in star_dict:
             training_data_dict[parameter] = star_dict[parameter]
@@ -38,7 +65,115 @@ def parse_relion(fp):
             raise Exception('STAR file is missing necessary parameter: %s' % parameter)
     assert(len(star_dict['rlnCoordinateX']) == len(star_dict['rlnCoordinateY']) == len(star_dict['rlnMicrographName'])) # sanity check
 
+    for column in columns:
+        if column in star_dict:
+            training_data_dict[column] = star_dict[column]
+        else:
+            warnings.warn('STAR file is missing requested column: %s' % column)
+
+    return training_data_dict
+
+def join_optics(particles_dict, optics_dict, keys):
+    # Returns a dictionary of key -> array of the value for every particle, for each of the keys
+    # found in the optics table. The rlnOpticsGroup of all particles is looked up in the optics
+    # table with one vectorized search, rather than merging row by row.
+    keys = [key for key in keys if key in optics_dict]
+    if optics_dict is particles_dict:
+        return dict((key, np.asarray(optics_dict[key])) for key in keys)
+    if not keys:
+        return {}
+
+    num_particles = len(particles_dict['rlnCoordinateX'])
+    num_groups = len(optics_dict[keys[0]])
+    optics_groups = np.asarray(optics_dict['rlnOpticsGroup']) if 'rlnOpticsGroup' in optics_dict else np.arange(1, num_groups + 1)
+    if 'rlnOpticsGroup' in particles_dict:
+        particle_groups = np.asarray(particles_dict['rlnOpticsGroup'])
+    else:
+        particle_groups = np.full(num_particles, optics_groups[0])
+
+    order = np.argsort(optics_groups)
+    rows = order[np.clip(np.searchsorted(optics_groups, particle_groups, sorter = order), 0, num_groups - 1)]
+    if np.any(optics_groups[rows] != particle_groups):
+        warnings.warn('STAR file has particles in optics groups missing from data_optics')
+
+    return dict((key, np.asarray(optics_dict[key])[rows]) for key in keys)
+
+def parse_relion_by_micrograph(fp, batch_size = 10000):
+    # Streaming variant of parse_relion for very large STAR files (eg - Refine3D run_itXXX_data.star).
+    # Rows are read from disk in batches and only the particle coordinates are kept, grouped by
+    # micrograph as flat x, y arrays, so the full particle table is never held in memory.
+    # Returns the same metadata keys as parse_relion, with the coordinates under 'micrographs'
+    # as a dictionary of micrograph name -> array('d', [x0, y0, x1, y1, ...]).
+
+    star_file = StarFile(fp, streaming = True)
+
+    training_data_dict = {}
+
+    # Metadata is found either in the optics loop at the start of the file (Relion 3.1)
+    # or in the first row of the particles loop (Relion 3.0), so only the first row is needed
+    metadata_list = ['rlnVoltage', 'rlnSphericalAberration', 'rlnAmplitudeContrast', 'rlnImagePixelSize']
+    for metadata in metadata_list:
+        rows = star_file.iterloop([metadata])
+        row = next(rows, None)
+        rows.close()
+        if row is None:
+            warnings.warn('STAR file is missing metadata: %s' % metadata)
+        else:
+            training_data_dict[metadata] = row[0]
+
+    micrographs = {}
+    num_particles = 0
+    parameter_list = ['rlnMicrographName', 'rlnCoordinateX', 'rlnCoordinateY']
+    for batch in star_file.iterloop(parameter_list, batch_size = batch_size):
+        for mic, x, y in batch:
+            try: coords = micrographs[mic]
+            except KeyError: coords = micrographs[mic] = array('d')
+            coords.append(x)
+            coords.append(y)
+        num_particles += len(batch)
+
+    if num_particles == 0:
+        raise Exception('STAR file is missing necessary parameters: %s' % ', '.join(parameter_list))
+
+    training_data_dict['micrographs'] = micrographs
+    training_data_dict['num_particles'] = num_particles
+
     return training_data_dict
 
+@register_reader('.star')
+def read_relion_particles(fp, cache_dir = None, stream = False, nproc = 1, parallel_threshold = PARALLEL_THRESHOLD):
+    # Reads a STAR file into a ParticleTable. The columns parsed by parse_relion are used as they are:
+    # the dictionary-encoded micrograph names give the micrographs and per-particle codes of the table.
+    # stream: parse with parse_relion_by_micrograph, for very large files (eg - Refine3D run_itXXX_data.star)
+    # cache_dir: if given, the parsed file is cached there (see parse_cache.py)
+    # nproc, parallel_threshold: particle tables of more than parallel_threshold bytes are parsed with nproc
+    # processes. They are not part of the cache key, as the parsed file is the same.
+
+    # By default, assume that the Relion project folder is two directories above the job folder of the STAR file
+    project_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(fp))))
+    metadata_list = ['rlnVoltage', 'rlnSphericalAberration', 'rlnAmplitudeContrast', 'rlnImagePixelSize']
+
+    if stream:
+        data_dict = parse_relion_by_micrograph(fp)
+        micrographs = list(data_dict['micrographs'].keys())
+        coords = [np.frombuffer(data_dict['micrographs'][mic]).reshape(-1, 2) for mic in micrographs]
+        counts = [len(mic_coords) for mic_coords in coords]
+        coords = np.concatenate(coords)
+        mic_codes = np.repeat(np.arange(len(micrographs), dtype = np.int32), counts)
+        score = class_number = None
+    else:
+        with warnings.catch_warnings():
+            # the score and class columns are optional (eg - Manual picks have neither)
+            warnings.filterwarnings('ignore', message = 'STAR file is missing requested column')
+            data_dict = cached_parse(parse_relion, fp, cache_dir,
+                    columns = ['rlnAutopickFigureOfMerit', 'rlnClassNumber'],
+                    options = {'nproc': nproc, 'parallel_threshold': parallel_threshold})
+        micrographs = data_dict['rlnMicrographName'].categories
+        mic_codes = data_dict['rlnMicrographName'].codes
+        coords = np.column_stack((data_dict['rlnCoordinateX'], data_dict['rlnCoordinateY']))
+        score = data_dict.get('rlnAutopickFigureOfMerit')
+        class_number = data_dict.get('rlnClassNumber')
 
-        
+    metadata = dict((key, data_dict[m]) for key, m in zip(ParticleTable.metadata_keys, metadata_list) if m in data_dict)
+    return ParticleTable(micrographs, mic_codes, coords[:, 0], coords[:, 1], score = score,
+            class_number = class_number, metadata = metadata, project_dir = project_dir)
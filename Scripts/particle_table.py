@@ -0,0 +1,200 @@
+######
+# Columnar in-memory table of particles, shared by the Relion and CryoSparc readers.
+#
+# Each particle file format registers a reader for its file extension with @register_reader. A reader
+# returns a ParticleTable, so grouping by micrograph, filtering and writing the training data to the
+# database are done by a single code path for every format. read_particles() picks the reader for a
+# file from its extension (the readers are registered when parse_relion.py and parse_csparc.py are
+# imported, as done by parse_particles.py).
+######
+
+import os
+import warnings
+import numpy as np
+from shutil import copyfile
+from job_store import write_job_store
+from micrograph_registry import MicrographRegistry
+
+READERS = {}
+
+def register_reader(*extensions):
+    # Decorator registering a function as the reader of particle files with the given extensions.
+    # The reader is called as reader(fp, **kwargs) and must return a ParticleTable.
+    def decorator(reader):
+        for ext in extensions:
+            READERS[ext.lower()] = reader
+        return reader
+    return decorator
+
+def read_particles(fp, **kwargs):
+    ext = os.path.splitext(fp)[-1].lower()
+    if ext not in READERS:
+        raise Exception('No particle reader for %s files: %s' % (ext, fp))
+    return READERS[ext](fp, **kwargs)
+
+def group_by_micrograph(mic_codes, num_micrographs):
+    # Groups the particles by micrograph in a single pass, instead of scanning every particle for each micrograph.
+    # mic_codes: index of the micrograph of each particle, from 0 to num_micrographs - 1
+    # Returns (present, order, bounds), where present holds the codes of the micrographs with particles,
+    # and the indices of the particles on micrograph present[k] are order[bounds[k]:bounds[k + 1]]
+    order = np.argsort(mic_codes, kind = 'stable')
+    counts = np.bincount(mic_codes, minlength = num_micrographs)
+    present = np.flatnonzero(counts)
+    bounds = np.concatenate(([0], np.cumsum(counts[present])))
+    return present, order, bounds
+
+def _link_target(path):
+    # Returns where a symbolic link points to, or None if path is not a link
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+def _link_micrograph(mic_path, output_path):
+    # Links a micrograph into the database, replacing a link to another path (eg - to the file before it was
+    # moved). The new link is created under a temporary name then renamed over the old one.
+    try:
+        os.symlink(mic_path, output_path)
+    except FileExistsError:
+        # linked before, or meanwhile by another job of the entry parsed in parallel
+        if _link_target(output_path) == mic_path:
+            return
+        tmp_path = '%s.%d.tmp' % (output_path, os.getpid())
+        os.symlink(mic_path, tmp_path)
+        os.replace(tmp_path, output_path)
+
+class ParticleTable(object):
+    """
+    Particles of a single job, stored as columns:
+        micrographs: array of the distinct micrograph paths, as written in the particle file
+        mic_codes: index into micrographs of the micrograph of each particle
+        x, y: particle coordinates in pixels
+        score, class_number: optional per-particle arrays, None when the file does not have them
+        metadata: dictionary with the 'voltage', 'cs', 'amp_contrast' and 'pixel_size' of the data
+        project_dir: folder that the micrograph paths are relative to
+    The arrays given are used as they are, without copies.
+    """
+
+    metadata_keys = ['voltage', 'cs', 'amp_contrast', 'pixel_size']
+
+    def __init__(self, micrographs, mic_codes, x, y, score = None, class_number = None, metadata = {}, project_dir = ''):
+        self.micrographs = np.asarray(micrographs)
+        self.mic_codes = np.asarray(mic_codes)
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.score = score
+        self.class_number = class_number
+        # missing metadata is set to 0, and can later be entered by the user within the GUI
+        self.metadata = dict((key, metadata.get(key, 0)) for key in self.metadata_keys)
+        self.project_dir = project_dir
+        self._groups = None
+        assert(len(self.mic_codes) == len(self.x) == len(self.y)) # sanity check
+
+    def __len__(self):
+        return len(self.x)
+
+    def groups(self):
+        # Returns (names, order, bounds) for the micrographs that have particles: the indices of the
+        # particles on micrograph names[k] are order[bounds[k]:bounds[k + 1]]
+        if self._groups is None:
+            present, order, bounds = group_by_micrograph(self.mic_codes, len(self.micrographs))
+            self._groups = (self.micrographs[present], order, bounds)
+        return self._groups
+
+    @property
+    def num_micrographs(self):
+        return len(self.groups()[0])
+
+    def coords(self):
+        return np.column_stack((self.x, self.y))
+
+    def filter(self, mask):
+        # Returns a table with the particles selected by a boolean mask or index array
+        select = lambda col: None if col is None else col[mask]
+        return ParticleTable(self.micrographs, self.mic_codes[mask], self.x[mask], self.y[mask],
+                score = select(self.score), class_number = select(self.class_number),
+                metadata = self.metadata, project_dir = self.project_dir)
+
+    def write(self, data_output_dir, mics_output_dir, mic_root = None, copy_mics = False, registry = None):
+        """
+        Writes the particles to the database as a job store (see job_store.py) in data_output_dir, along
+        with its info.txt and data.txt export, and links
+        (or copies if copy_mics is set) their micrographs into mics_output_dir. Micrograph paths are
+        resolved relative to mic_root, by default the project folder of the particle file.
+        Micrographs are resolved with registry (see micrograph_registry.py), so micrographs shared with
+        other jobs are resolved once, and micrographs that were moved are linked from where they are now.
+        Micrographs that cannot be found are listed in info.txt.
+        Returns a dictionary with the 'num_particles', 'num_mics', 'metadata' and 'missing_mics' written,
+        and the (name, path, size in bytes) of the micrographs found under 'micrographs'.
+        """
+        if mic_root is None:
+            mic_root = self.project_dir
+        names, order, bounds = self.groups()
+        coords = self.coords()
+        voltage = self.metadata['voltage']
+        cs = self.metadata['cs']
+        amp_cont = self.metadata['amp_contrast']
+        pix_size = self.metadata['pixel_size']
+
+        info_f = open(os.path.join(data_output_dir, 'info.txt'), 'w')
+        info_f.write('Number of Particles: %d\n' % len(self))
+        info_f.write('Number of Micrographs: %d\n' % len(names))
+        info_f.write('Voltage: %d\n' % voltage)
+        info_f.write('Spherical Aberration (CS): %g\n' % cs)
+        info_f.write('Amplitude Contrast: %g\n' % amp_cont)
+        info_f.write('Pixel Size: %g\n' % pix_size)
+        info_f.write('$\n') #'$' will be used as the delimiter between sections
+        info_f.write('Missing Micrographs\n')
+
+        data_f = open(os.path.join(data_output_dir, 'data.txt'), 'w')
+        # write particle metadata to data file on disk
+        data_f.write('Voltage %d\n' % voltage)
+        data_f.write('CS %g\n' % cs)
+        data_f.write('AmpContrast %g\n' % amp_cont)
+        data_f.write('PixelSize %g\n' % pix_size)
+        data_f.write('$\n') #'$' will be used as the delimiter between sections
+
+        if registry is None:
+            registry = MicrographRegistry()
+        # the micrographs are resolved by listing their folders, and the folder they are linked into, once
+        sources = registry.resolve([os.path.join(mic_root, mic) for mic in names])
+        linked = set(os.listdir(mics_output_dir)) if not copy_mics else set()
+
+        missing_mics = []
+        linked_mics = []
+        mic_names = []
+        # write the training data to disk, organized by micrograph
+        for k, mic in enumerate(names):
+            mic_name = os.path.basename(mic)
+            mic_names.append(mic_name)
+            # save/copy over the necessary micrographs to disk
+            if sources[k] is not None:
+                mic_path, mic_size = sources[k]
+                linked_mics.append((mic_name, mic_path, mic_size))
+                output_path = os.path.join(mics_output_dir, mic_name)
+                if copy_mics:
+                    copyfile(mic_path, output_path)
+                elif mic_name not in linked or _link_target(output_path) != mic_path:
+                    # Create a symbolic link to the actual micrograph, or point the link to where the micrograph moved
+                    # This should be default behavior to save disk space
+                    _link_micrograph(mic_path, output_path)
+                    linked.add(mic_name)
+            else:
+                # issue a warning that a particular micrograph does not exist
+                # record missing micrographs in the info file
+                warnings.warn("WARNING: The micrograph '%s' cannot be found. It will not be stored in the database." % mic_name)
+                info_f.write('%s\n' % mic_name)
+                missing_mics.append(mic_name)
+
+            data_f.write('Micrograph %s\n' % mic_name)
+            # write all the particles (x, y locations) belonging to this micrograph
+            np.savetxt(data_f, coords[order[bounds[k]:bounds[k + 1]]], fmt = '%f %f')
+            data_f.write('$\n')
+
+        info_f.close()
+        data_f.close()
+
+        write_job_store(data_output_dir, mic_names, coords[order], bounds, self.metadata, missing_mics)
+
+        return {'num_particles': len(self), 'num_mics': len(names), 'metadata': self.metadata,
+                'missing_mics': missing_mics, 'micrographs': linked_mics}
@@ -0,0 +1,116 @@
+######
+# Process graph of a Relion project, read from its default_pipeline.star.
+#
+# Relion records every job of a project in the default_pipeline.star file of the project folder:
+#   data_pipeline_processes: name (eg - 'Select/job005/'), alias, type and status of each job
+#   data_pipeline_nodes: files written and read by the jobs
+#   data_pipeline_input_edges: files read by each job (from node -> process)
+#   data_pipeline_output_edges: files written by each job (process -> to node)
+# Reading this one file gives the type and status of every job of the project, and the jobs each job takes
+# its input from, without opening the job folders. Each job folder also holds a job_pipeline.star of the
+# same format, describing that job alone.
+#
+# Relion 3 stores the status of jobs as a number and Relion 4 as a label. The type of a job is taken from
+# the folder of the job (eg - 'Select'), which is the same in every version.
+######
+
+import os
+from EMAN2star import StarFile
+
+# status of a job that finished successfully, in Relion 3 and Relion 4
+RELION3_SUCCEEDED = 2
+RELION4_SUCCEEDED = 'Succeeded'
+
+def process_type(process):
+    # Returns the type of a job from its name, eg - 'Select' for 'Select/job005/'
+    return process.split('/')[0]
+
+def _loop_rows(star_file, block, keys):
+    # Returns the rows of the loop of a block of a STAR file, as tuples of the values of keys, or [] if the
+    # block or any of the keys is missing
+    if block not in star_file.getindex():
+        return []
+    block_file = star_file.readblock(block)
+    if not all(key in block_file for key in keys):
+        return []
+    return list(zip(*[block_file[key] for key in keys]))
+
+class RelionPipeline(object):
+    """
+    Process graph of the jobs of a Relion project, read from pipeline STAR files.
+    processes: name of each job (eg - 'Select/job005/'), in the order they were read
+    statuses: status of each job (a number in Relion 3, a label in Relion 4), if known
+    inputs: names of the jobs that wrote the files each job reads, in the order of its input edges
+    """
+
+    def __init__(self, star_fp = None):
+        self.processes = []
+        self.statuses = {}
+        self.inputs = {}
+        if star_fp is not None:
+            self.read(star_fp)
+
+    def add_process(self, process, status = None):
+        if process not in self.inputs:
+            self.processes.append(process)
+            self.inputs[process] = []
+        if status is not None:
+            self.statuses[process] = status
+
+    def read(self, star_fp):
+        """
+        Adds the jobs and edges of a pipeline STAR file (default_pipeline.star or job_pipeline.star) to the graph.
+        Returns whether the file could be read. A missing or unreadable file adds nothing.
+        """
+        if not os.path.isfile(star_fp):
+            return False
+        try:
+            star_file = StarFile(star_fp, streaming = True)
+            status_key = 'rlnPipeLineProcessStatusLabel'
+            processes = _loop_rows(star_file, 'pipeline_processes', ['rlnPipeLineProcessName', status_key])
+            if not processes:
+                status_key = 'rlnPipeLineProcessStatus'
+                processes = _loop_rows(star_file, 'pipeline_processes', ['rlnPipeLineProcessName', status_key])
+            output_edges = _loop_rows(star_file, 'pipeline_output_edges', ['rlnPipeLineEdgeProcess', 'rlnPipeLineEdgeToNode'])
+            input_edges = _loop_rows(star_file, 'pipeline_input_edges', ['rlnPipeLineEdgeFromNode', 'rlnPipeLineEdgeProcess'])
+        except Exception:
+            return False
+
+        for process, status in processes:
+            self.add_process(str(process), status)
+        # job that wrote each file. Files not written by a job of the file are taken to be written by the job
+        # of their folder, eg - 'Class2D/job004/' for 'Class2D/job004/run_it025_model.star'.
+        writers = dict((str(node), str(process)) for process, node in output_edges)
+        for node, process in input_edges:
+            node, process = str(node), str(process)
+            writer = writers.get(node, '/'.join(node.split('/')[:2]) + '/')
+            self.add_process(process)
+            if writer != process and writer not in self.inputs[process]:
+                self.inputs[process].append(writer)
+        return True
+
+    def succeeded(self, process):
+        # Returns whether the pipeline records a job as finished successfully
+        return self.statuses.get(process) in (RELION3_SUCCEEDED, RELION4_SUCCEEDED)
+
+    def jobs(self, job_type):
+        # Returns the names of the jobs of a type, eg - 'Refine3D'
+        return [process for process in self.processes if process_type(process) == job_type]
+
+    def source(self, process, job_types):
+        # Returns the first job of one of job_types a job takes its input from, or None
+        for writer in self.inputs.get(process, []):
+            if process_type(writer) in job_types:
+                return writer
+        return None
+
+    def upstream(self, process):
+        # Returns the names of all the jobs a job takes its input from, directly or through other jobs
+        lineage = set()
+        stack = list(self.inputs.get(process, []))
+        while stack:
+            writer = stack.pop()
+            if writer not in lineage:
+                lineage.add(writer)
+                stack.extend(self.inputs.get(writer, []))
+        return lineage
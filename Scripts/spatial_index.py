@@ -0,0 +1,155 @@
+######
+# Spatial index over the particle coordinates of a job, for radius, box and k-nearest neighbour queries.
+#
+# The particles of each micrograph are binned into a uniform grid of square cells. Every particle gets an
+# int64 key packing its micrograph and cell, and the keys are stored sorted along with the particles in
+# that order. The cells of one micrograph and one grid column then form a contiguous range of keys, so a
+# box query only needs one binary search per column of cells it covers.
+#
+# The index is built the first time a job is queried and saved next to its job store:
+#   particles_grid_keys.npy: sorted cell keys
+#   particles_grid_order.npy: particles of the job in the order of the keys
+#   particles_grid.json: cell size, and the job store the index was built for
+# It is built again if the job store was written since (eg - when the entry was deduplicated).
+#
+# Queries return the positions of particles in the job, in the same order as the particles of JobStore.
+# Queries across a whole entry are run on its shared particle table (see dedup.py), which holds every
+# distinct particle of the entry once.
+######
+
+import os
+import json
+import numpy as np
+from job_store import STORE_HEADER, shared_dir, open_job_store
+from db_commit import atomic_write_json
+
+DEFAULT_CELL_SIZE = 64.0
+GRID_HEADER = 'particles_grid.json'
+GRID_ARRAYS = {'keys': 'particles_grid_keys.npy',
+               'order': 'particles_grid_order.npy'}
+
+# grid cells are packed into one int64 key per particle: 21 bits per cell coordinate, 21 bits for the micrograph
+CELL_BITS = 21
+CELL_BIAS = 1 << (CELL_BITS - 1)
+
+def cell_keys(mic_codes, cells):
+    # Packs the micrograph codes and (N, 2) grid cells of particles into sortable int64 keys
+    cells = np.clip(cells, -CELL_BIAS, CELL_BIAS - 1)
+    return ((np.asarray(mic_codes, dtype = np.int64) << (2 * CELL_BITS)) |
+            ((cells[..., 0] + CELL_BIAS) << CELL_BITS) | (cells[..., 1] + CELL_BIAS))
+
+class SpatialIndex(object):
+    """
+    Uniform grid index of the particles of a job store (see job_store.py). Micrographs are given by name or path.
+    """
+
+    def __init__(self, store, keys, order, cell_size):
+        self.store = store
+        self.keys = keys
+        self.order = order
+        self.cell_size = cell_size
+
+    @classmethod
+    def build(cls, store, cell_size = DEFAULT_CELL_SIZE):
+        mic_codes = np.repeat(np.arange(store.num_micrographs), np.diff(store.offsets))
+        cells = np.floor(store.particle_coords() / cell_size).astype(np.int64)
+        keys = cell_keys(mic_codes, cells)
+        order = np.argsort(keys, kind = 'stable')
+        return cls(store, keys[order], order, cell_size)
+
+    def save(self):
+        job_dir = self.store.job_dir
+        np.save(os.path.join(job_dir, GRID_ARRAYS['keys']), self.keys)
+        np.save(os.path.join(job_dir, GRID_ARRAYS['order']), self.order)
+        header = {'cell_size': self.cell_size,
+                  'num_particles': len(self.order),
+                  'store_mtime_ns': os.stat(os.path.join(job_dir, STORE_HEADER)).st_mtime_ns}
+        atomic_write_json(os.path.join(job_dir, GRID_HEADER), header, indent = 1)
+
+    @classmethod
+    def load(cls, store, cell_size = None, mmap = True):
+        # Returns the index saved with a job store, or None if there is none, or it is out of date
+        job_dir = store.job_dir
+        try:
+            with open(os.path.join(job_dir, GRID_HEADER)) as header_f:
+                header = json.load(header_f)
+        except (IOError, ValueError):
+            return None
+        if (header['num_particles'] != len(store) or
+                header['store_mtime_ns'] != os.stat(os.path.join(job_dir, STORE_HEADER)).st_mtime_ns or
+                (cell_size is not None and header['cell_size'] != cell_size)):
+            return None
+        mmap_mode = 'r' if mmap else None
+        keys = np.load(os.path.join(job_dir, GRID_ARRAYS['keys']), mmap_mode = mmap_mode)
+        order = np.load(os.path.join(job_dir, GRID_ARRAYS['order']), mmap_mode = mmap_mode)
+        return cls(store, keys, order, header['cell_size'])
+
+    def _micrograph(self, mic_name):
+        k = self.store.micrograph_index(mic_name)
+        if k is None:
+            raise KeyError(mic_name)
+        return k
+
+    def _cells(self, k, x0, y0, x1, y1):
+        # Returns the particles in the grid cells covering a box of micrograph k
+        cx0, cy0 = np.floor(np.array([x0, y0]) / self.cell_size).astype(np.int64)
+        cx1, cy1 = np.floor(np.array([x1, y1]) / self.cell_size).astype(np.int64)
+        columns = np.arange(max(cx0, -CELL_BIAS), min(cx1, CELL_BIAS - 1) + 1)
+        first = cell_keys(k, np.column_stack((columns, np.full(len(columns), cy0))))
+        last = cell_keys(k, np.column_stack((columns, np.full(len(columns), cy1))))
+        lo = np.searchsorted(self.keys, first, side = 'left')
+        hi = np.searchsorted(self.keys, last, side = 'right')
+        return np.concatenate([self.order[a:b] for a, b in zip(lo, hi)] + [np.empty(0, dtype = np.int64)])
+
+    def box(self, mic_name, x0, y0, x1, y1):
+        # Returns the particles of a micrograph with x0 <= x <= x1 and y0 <= y <= y1
+        candidates = self._cells(self._micrograph(mic_name), x0, y0, x1, y1)
+        coords = self.store.particle_coords(candidates)
+        inside = (coords[:, 0] >= x0) & (coords[:, 0] <= x1) & (coords[:, 1] >= y0) & (coords[:, 1] <= y1)
+        return np.sort(candidates[inside])
+
+    def radius(self, mic_name, x, y, r):
+        # Returns the particles of a micrograph within distance r of (x, y)
+        candidates = self._cells(self._micrograph(mic_name), x - r, y - r, x + r, y + r)
+        dist2 = np.sum((self.store.particle_coords(candidates) - np.array([x, y])) ** 2, axis = 1)
+        return np.sort(candidates[dist2 <= r * r])
+
+    def knn(self, mic_name, x, y, k):
+        """
+        Returns the k particles of a micrograph nearest to (x, y), or all of them if it has fewer,
+        as (particles, distances) sorted by distance.
+        """
+        mic = self._micrograph(mic_name)
+        num_mic_particles = int(self.store.offsets[mic + 1] - self.store.offsets[mic])
+        r = self.cell_size
+        while True:
+            candidates = self._cells(mic, x - r, y - r, x + r, y + r)
+            dist = np.sqrt(np.sum((self.store.particle_coords(candidates) - np.array([x, y])) ** 2, axis = 1))
+            nearest = np.argsort(dist, kind = 'stable')[:k]
+            # the k nearest are known once they are all within r, as every particle within r was searched
+            if len(candidates) == num_mic_particles or (len(nearest) == k and (k == 0 or dist[nearest[-1]] <= r)):
+                return candidates[nearest], dist[nearest]
+            r *= 2
+
+    def coords(self, particles):
+        # Returns the (x, y) coordinates of particles returned by a query
+        return self.store.particle_coords(particles)
+
+def open_spatial_index(job_dir, cell_size = None, mmap = True):
+    """
+    Returns the SpatialIndex of a job folder (or the shared particle folder of an entry), building and
+    saving it if it does not exist yet or is out of date. cell_size defaults to DEFAULT_CELL_SIZE pixels.
+    """
+    store = open_job_store(job_dir, mmap = mmap)
+    index = SpatialIndex.load(store, cell_size, mmap = mmap)
+    if index is None:
+        index = SpatialIndex.build(store, DEFAULT_CELL_SIZE if cell_size is None else cell_size)
+        index.save()
+    return index
+
+def open_entry_spatial_index(entry_path, cell_size = None, mmap = True):
+    # Returns the SpatialIndex of all the distinct particles of an entry, over its shared particle table
+    shared_path = shared_dir(entry_path)
+    if shared_path is None:
+        raise Exception('Entry %s has no shared particle table: deduplicate it with dedup.py first.' % entry_path)
+    return open_spatial_index(shared_path, cell_size, mmap = mmap)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
 import os
-import subprocess
+import shutil
+import numpy as np
+from job_store import open_job_store
 
 def topaz_train(job_folders, output_folder, save_prefix='models', output='models/model_training.txt', downsample=8):
     """
@@ -33,33 +35,24 @@ def topaz_train(job_folders, output_folder, save_prefix='models', output='models
     total_mics = 0
 
     for job_folder in job_folders:
-        with open(os.path.join(job_folder, 'data.txt')) as data_f:
-            all_data = data_f.read()
-            all_data = all_data.split('$')[:-1]
-
-            for mic_data in all_data[1:]:
-                # list and filter func. used to get rid of empty strings just in case
-                mic_name = list(filter(None, mic_data.split('\n')))[0].split()[-1]
-                mic_path = os.path.normpath(os.path.join(particle_data_file, '../../../Micrographs/%s' % mic_name))
-
-                if os.path.exists(mic_path):
-                    # copy the necessary micrographs over to micrographs/raw/, which will later be preprocessed
-                    shutil.copy(mic_path, raw_mics_dir, follow_symlinks=False)
-
-                    # reformat particles to the format used by Topaz and save them to particles.txt
-                    particle_data = list(filter(None, mic_data.split('\n')))[1:]
-                    for particle in particle_data:
-                        x, y = particle.split()
-                        x = round(float(x))
-                        y = round(float(y))
-                        particles_file.write('{}\t{:<4d}\t{:<4d}\n'.format(mic_name, x, y))
-
-        with open(os.path.join(job_folder, 'info.txt')) as info_f:
-            total_particles += int(info_f.readline().split(':')[-1])
-            total_mics += int(info_f.readline().split(':')[-1])
+        # particles are read from the job store of the job folder, without parsing data.txt
+        store = open_job_store(job_folder)
+        for mic_name, coords in store:
+            mic_path = os.path.normpath(os.path.join(job_folder, '../../Micrographs/%s' % mic_name))
+
+            if os.path.exists(mic_path):
+                # copy the necessary micrographs over to micrographs/raw/, which will later be preprocessed
+                shutil.copy(mic_path, raw_dir, follow_symlinks=False)
+
+                # reformat particles to the format used by Topaz and save them to particles.txt
+                np.savetxt(particles_file, np.round(coords).astype(int),
+                           fmt='%s\t%%-4d\t%%-4d' % mic_name.replace('%', '%%'))
+
+        total_particles += len(store)
+        total_mics += store.num_micrographs
 
     particles_file.close()
-    avg_particles_per_mic = round(total_particles / total_mic)
+    avg_particles_per_mic = round(total_particles / total_mics)
 
     # Create Slurm script for preprocessing and training
     script_path = os.path.join(output_folder, 'topaz_train.slurm')
@@ -79,7 +72,7 @@ def topaz_train(job_folders, output_folder, save_prefix='models', output='models
         slurm_f.write("topaz preprocess -v -s {} -o {} {}\n".format(downsample, processed_dir, os.path.join(raw_dir, "*.mrc")))
         slurm_f.write("topaz convert -s {} -o {} {}\n".format(downsample, os.path.join(processed_dir, "particles.txt"), os.path.join(raw_dir, "particles.txt")))
         slurm_f.write("topaz train -n {} \
-                                   --num-workers=12 \ 
+                                   --num-workers=12 \
                                    --train-images {} \
                                    --train-targets {} \
                                    --save-prefix={} \
@@ -114,6 +107,7 @@ def topaz_pick(output, mics_folder, model, particle_radius=14, upsample=8):
 def main():
 
     #Do some testing
+    pass
 
 if __name__ == '__main__':
     main()
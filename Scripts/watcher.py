@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+######
+# Watcher daemon parsing the jobs of Relion and CryoSparc projects into the database as they finish.
+#
+# Projects are registered with the watcher in the catalog of the database (see catalog.py). Each project
+# is polled on its own adaptive interval: polled every min_interval seconds while it changes, and half
+# as often after each poll finding no change, up to max_interval seconds.
+#
+# A poll does not list the project again. It compares the modification times of the folders a new or
+# finishing job changes against those of the last poll: the project folder and the job type folders
+# (Relion), default_pipeline.star (Relion), and the folders and job.json files of the jobs not finished
+# yet. Only when one changed are the job folders listed. When jobs finished since the last poll (ie - Relion
+# wrote RELION_JOB_EXIT_SUCCESS in the job folder, or the status in the job.json of the CryoSparc job is
+# 'completed'), the project is parsed incrementally, with only its finished jobs (see file_crawler.py).
+# Jobs found finished are not read again, and a CryoSparc project is parsed from the job.json files read
+# by the poll, so the job.json of each job is read once per poll until the job finishes.
+#
+# Example usage: $watcher.py --add /net/scratch/Structures/EMPIAR-10117
+#                $watcher.py
+######
+
+import os
+import re
+import time
+import argparse
+from catalog import Catalog
+from file_crawler import (DB_LOC, RELION_JOB_TYPES, CSPARC_COMPLETED_STATUS, project_types, entry_name_for,
+        relion_job_finished, read_csparc_job, csparc_job_index, parse_relion_project, parse_csparc_project)
+
+DEFAULT_MIN_INTERVAL = 30
+DEFAULT_MAX_INTERVAL = 600
+
+class ProjectWatch(object):
+    """
+    Polling state of a watched project: the modification times of the files and folders polled, the
+    finished jobs of the project at the last poll, and its polling interval.
+    """
+
+    def __init__(self, project_dir, source, entry_name, interval = DEFAULT_MIN_INTERVAL):
+        self.project_dir = project_dir
+        self.source = source
+        self.entry_name = entry_name
+        # path -> modification time at the last poll, or None if the project must be listed at the next poll
+        self.mtimes = None
+        self.finished = set()
+        # (type, status) of each job folder of a CryoSparc project, read from its job.json
+        self.csparc_jobs = {}
+        self.interval = interval
+        self.next_poll = 0
+
+    def _changed(self):
+        if self.mtimes is None:
+            return True
+        for path, mtime_ns in self.mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                if mtime_ns is not None:
+                    return True
+        return False
+
+    def _scan(self):
+        # Lists the job folders of the project, returning the finished jobs, the modification times to poll and,
+        # for a CryoSparc project, the (type, status) of its job folders. Jobs finished at the last poll are not
+        # read again.
+        mtimes = {}
+        finished = set()
+        csparc_jobs = {}
+
+        def add_mtime(path):
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+
+        add_mtime(self.project_dir)
+        if self.source == 'relion':
+            add_mtime(os.path.join(self.project_dir, 'default_pipeline.star'))
+            parents = [os.path.join(self.project_dir, job_type) for job_type in RELION_JOB_TYPES]
+        else:
+            parents = [self.project_dir]
+
+        for parent in parents:
+            add_mtime(parent)
+            try:
+                entries = list(os.scandir(parent))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks = False):
+                    continue
+                if entry.path in self.finished:
+                    is_finished = True
+                    if entry.path in self.csparc_jobs:
+                        csparc_jobs[entry.path] = self.csparc_jobs[entry.path]
+                elif self.source == 'relion':
+                    is_finished = relion_job_finished(entry.path)
+                elif re.match(r'J\d', entry.name):
+                    csparc_jobs[entry.path] = read_csparc_job(entry.path)
+                    is_finished = csparc_jobs[entry.path][1] == CSPARC_COMPLETED_STATUS
+                else:
+                    continue
+                if is_finished:
+                    finished.add(entry.path)
+                else:
+                    # jobs are polled until they finish
+                    add_mtime(entry.path)
+                    if self.source == 'csparc':
+                        add_mtime(os.path.join(entry.path, 'job.json'))
+        return finished, mtimes, csparc_jobs
+
+    def poll(self, cache_dir = None):
+        """
+        Polls the project, and parses it if jobs finished since the last poll.
+        Returns whether the project changed since the last poll.
+        """
+        if not self._changed():
+            return False
+        finished, mtimes, csparc_jobs = self._scan()
+        if finished - self.finished:
+            # listed again at the next poll if the parse fails
+            self.mtimes = None
+            if self.source == 'relion':
+                parsed = parse_relion_project(self.project_dir, self.entry_name, cache_dir = cache_dir, incremental = True,
+                        finished_only = True)
+            else:
+                # the jobs are parsed from the job.json files read by this poll
+                parsed = parse_csparc_project(self.project_dir, self.entry_name, cache_dir = cache_dir, incremental = True,
+                        finished_only = True, job_index = csparc_job_index(csparc_jobs))
+            if parsed is False:
+                # the entry is being written by another process
+                return True
+            print('%s: parsed %d newly finished jobs of %s' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                    len(finished - self.finished), self.project_dir))
+        self.finished = finished
+        self.csparc_jobs = csparc_jobs
+        self.mtimes = mtimes
+        return True
+
+def watch_projects(min_interval = DEFAULT_MIN_INTERVAL, max_interval = DEFAULT_MAX_INTERVAL, cache_dir = None, once = False):
+    """
+    Polls the projects registered in the catalog until interrupted, parsing their jobs as they finish.
+    Projects registered or removed while running are picked up within min_interval seconds.
+    If once is set, polls every project once and returns.
+    """
+    watches = {}
+    while True:
+        with Catalog(DB_LOC) as catalog:
+            registered = catalog.watched_projects()
+        watches = dict((row['project_dir'], watches.get(row['project_dir']) or
+                ProjectWatch(row['project_dir'], row['source'], row['entry'], min_interval)) for row in registered)
+
+        for project in watches.values():
+            if project.next_poll > time.time():
+                continue
+            try:
+                changed = project.poll(cache_dir)
+            except Exception as e:
+                print('Failed to parse the project %s: %s: %s' % (project.project_dir, type(e).__name__, e))
+                changed = False
+            # projects that change are polled often, and idle projects less and less often
+            project.interval = min_interval if changed else min(2 * project.interval, max_interval)
+            project.next_poll = time.time() + project.interval
+
+        if once:
+            return
+        next_poll = min([project.next_poll for project in watches.values()] + [time.time() + min_interval])
+        time.sleep(max(0, next_poll - time.time()))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Watch Relion and CryoSparc projects, and parse their jobs into the database as they finish.')
+    parser.add_argument('--add', metavar = 'PROJECT_DIR', help = 'Register a project folder with the watcher')
+    parser.add_argument('--name', help = 'Name of the database entry of the project registered (default: name of its folder, '
+            'followed by a hash of its path if another project has an entry of that name)')
+    parser.add_argument('--remove', metavar = 'PROJECT_DIR', help = 'Stop watching a project folder')
+    parser.add_argument('--list', action = 'store_true', help = 'List the projects watched')
+    parser.add_argument('--min-interval', type = float, default = DEFAULT_MIN_INTERVAL,
+            help = 'Seconds between the polls of a project that changes')
+    parser.add_argument('--max-interval', type = float, default = DEFAULT_MAX_INTERVAL,
+            help = 'Largest number of seconds between the polls of an idle project')
+    parser.add_argument('--cache-dir', help = 'Folder caching parsed particle files (see parse_cache.py)')
+    parser.add_argument('--once', action = 'store_true', help = 'Poll every project once, then exit')
+    args = parser.parse_args()
+
+    if args.add or args.remove or args.list:
+        with Catalog(DB_LOC) as catalog:
+            if args.add:
+                types = project_types(os.listdir(args.add))
+                if not types:
+                    raise Exception('%s is not a Relion or CryoSparc project folder.' % args.add)
+                catalog.watch_project(args.add, types[0], args.name or entry_name_for(args.add, catalog))
+            if args.remove:
+                catalog.unwatch_project(args.remove)
+            if args.list:
+                for row in catalog.watched_projects():
+                    print('%s (%s) -> %s' % (row['project_dir'], row['source'], row['entry']))
+        return
+
+    watch_projects(args.min_interval, args.max_interval, cache_dir = args.cache_dir, once = args.once)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Scripts'))
+from dedup import match_particles
+
+def test_contested_reference_goes_to_closest_particle():
+    # both particles are closest to the reference at (0, 0), which goes to the particle 0.5 px away,
+    # and the other particle falls back to the reference at (10, 0)
+    ref_coords = np.array([[0, 0], [10, 0]], dtype = np.float32)
+    coords = np.array([[4, 0], [0.5, 0]], dtype = np.float32)
+    matched = match_particles(np.zeros(2, dtype = np.int64), ref_coords, np.zeros(2, dtype = np.int64), coords, tolerance = 7)
+    assert matched.tolist() == [1, 0]
+
+def test_particles_on_other_micrographs_do_not_match():
+    ref_coords = np.array([[0, 0]], dtype = np.float32)
+    coords = np.array([[1, 0], [1, 0]], dtype = np.float32)
+    matched = match_particles(np.array([0]), ref_coords, np.array([1, 0]), coords, tolerance = 5)
+    assert matched.tolist() == [-1, 0]